@@ -0,0 +1,71 @@
+# Storage size and accuracy of each embedding storage type, against float64.
+#
+#     python -m benchmarks.embedding_dtypes [models] [dimensions]
+import sys
+
+import numpy as np
+
+from llm_survey.data import EMBEDDING_DTYPES, decode_embedding, encode_embedding
+from llm_survey.embeddings import ConsistencyEngine, SimilarityMatrix
+
+
+def summarise(labels, groups):
+    sums = [groups[label].sum(axis=0) for label in labels]
+    consistency = ConsistencyEngine(groups)
+    return (
+        SimilarityMatrix(labels, sums),
+        np.array([consistency.measure(label) for label in labels]),
+    )
+
+
+def main(models=300, dimensions=1536, outputs=3, k=5):
+    rng = np.random.default_rng(0)
+    labels = [f"model-{i}" for i in range(models)]
+    # Families of models give similar answers, and each model is fairly
+    # consistent with itself, some more than others.
+    families = rng.normal(size=(20, dimensions))
+    centres = families[rng.integers(0, 20, models)] + rng.normal(
+        size=(models, dimensions)
+    )
+    vectors = {
+        label: centre + rng.normal(size=(outputs, dimensions)) * rng.uniform(0.2, 1)
+        for label, centre in zip(labels, centres)
+    }
+
+    reference, reference_consistency = summarise(labels, vectors)
+    reference_nearest = reference.nearest(k)
+    reference_order = np.argsort(-reference_consistency)
+
+    print(f"{models} models x {outputs} outputs, {dimensions} dimensions")
+    for dtype in EMBEDDING_DTYPES:
+        size = 0
+        decoded = {}
+        for label, group in vectors.items():
+            rows = []
+            for vector in group:
+                blob, scale = encode_embedding(vector, dtype)
+                size += len(blob) + (8 if scale is not None else 0)
+                rows.append(decode_embedding(blob, dtype, scale))
+            decoded[label] = np.array(rows, dtype=np.float64)
+
+        similarities, consistency = summarise(labels, decoded)
+        nearest = similarities.nearest(k)
+        overlap = np.mean(
+            [
+                len(set(nearest[label]) & set(reference_nearest[label])) / k
+                for label in labels
+            ]
+        )
+        moved = np.sum(np.argsort(-consistency) != reference_order)
+
+        print(
+            f"{dtype:>8}: {size / 2**20:6.1f} MiB, "
+            f"similarity error {np.abs(similarities.matrix - reference.matrix).max():.1e}, "
+            f"top-{k} overlap {overlap:.1%}, "
+            f"consistency error {np.abs(consistency - reference_consistency).max():.1e}, "
+            f"{moved} models move in the consistency ranking"
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,33 @@
+# Compare the per-pair similarity filter with SimilarityMatrix.
+#
+#     python -m benchmarks.similarity_matrix [models] [dimensions]
+import sys
+import time
+
+import numpy as np
+
+from llm_survey.embeddings import SimilarityMatrix, similarity
+
+
+def main(models=300, dimensions=1536):
+    rng = np.random.default_rng(0)
+    labels = [f"model-{i}" for i in range(models)]
+    vectors = list(rng.normal(size=(models, dimensions)))
+
+    start = time.perf_counter()
+    pairwise = [[similarity(a, b) for b in vectors] for a in vectors]
+    pairwise_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matrix = SimilarityMatrix(labels, vectors)
+    cells = [[matrix[(a, b)] for b in labels] for a in labels]
+    matrix_time = time.perf_counter() - start
+
+    assert np.allclose(pairwise, cells, atol=1e-5)
+    print(f"{models} models, {dimensions} dimensions")
+    print(f"pairwise filter:   {pairwise_time:.3f}s")
+    print(f"similarity matrix: {matrix_time:.3f}s ({pairwise_time / matrix_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -1,61 +1,136 @@
+import hashlib
+import json
+import os
+from collections import Counter
 from decimal import Decimal
+from functools import cached_property
 
 import click
 from tqdm import tqdm
 
-from llm_survey.data import SurveyDb, groupby
-from llm_survey.embeddings import consistency_grid, consistency_measure, similarity
+from llm_survey.data import MICROS, SurveyDb, groupby
+from llm_survey.embeddings import (
+    Clusters,
+    ConsistencyEngine,
+    SimilarityMatrix,
+    clusters_path,
+)
+from llm_survey.store import EmbeddingStore
 from llm_survey.templating import model_company, model_file, render_to_file
 
 
 class ModelOutputs:
-    def __init__(self, data):
+    def __init__(
+        self, data, vectors, aggregates, embedding_model, neighbours_path=None
+    ):
         self.data = dict(data)
-        self.summed_models = sum_each_model(self.data)
-
-    def by_similarity(self, model_id):
-        return sorted(
-            (
-                other_model
-                for other_model in self.summed_models
-                if other_model != model_id
-            ),
-            key=lambda other: similarity(
-                self.summed_models[model_id], self.summed_models[other]
-            ),
-            reverse=True,
-        )
+        self.vectors = vectors
+        self.aggregates = aggregates
+        self.embedding_key = f"embedding:{embedding_model}"
+        self.summed_models = {
+            model: self.summed_embedding(model) for model in self.data
+        }
+        self.neighbours_path = neighbours_path
+        self.neighbours = {}
+
+    def aggregate(self, model_id, evaluator=""):
+        return self.aggregates.get((model_id, evaluator))
+
+    def embedding_aggregate(self, model_id):
+        # Only used when every output of the model has been embedded.
+        outputs = self.aggregate(model_id)
+        embeddings = self.aggregate(model_id, self.embedding_key)
+        if outputs and embeddings and embeddings.sample_count == outputs.sample_count:
+            return embeddings
+        return None
+
+    def summed_embedding(self, model_id):
+        embeddings = self.embedding_aggregate(model_id)
+        return embeddings.embedding if embeddings else None
+
+    def consistency(self, model_id):
+        embeddings = self.embedding_aggregate(model_id)
+        return embeddings.consistency() if embeddings else None
+
+    @cached_property
+    def similarities(self):
+        models = list(self.summed_models)
+        return SimilarityMatrix(models, [self.summed_models[model] for model in models])
+
+    def fingerprint(self):
+        digest = hashlib.sha256()
+        for model in sorted(self.summed_models):
+            vector = self.summed_models[model]
+            digest.update(model.encode() + b"\0")
+            digest.update(b"" if vector is None else vector.tobytes())
+        return digest.hexdigest()
+
+    def nearest(self, model_id, k=5):
+        if k not in self.neighbours:
+            self.neighbours[k] = self.load_neighbours(k)
+        return self.neighbours[k].get(model_id, [])
+
+    def load_neighbours(self, k):
+        # Top-k tables are saved with a fingerprint of the summed embeddings,
+        # so a build with no new embeddings reuses them.
+        fingerprint = self.fingerprint()
+        saved = {}
+        if self.neighbours_path and self.neighbours_path.exists():
+            saved = json.loads(self.neighbours_path.read_text())
+        if saved.get("fingerprint") != fingerprint:
+            saved = {"fingerprint": fingerprint, "tables": {}}
+        if str(k) in saved["tables"]:
+            return saved["tables"][str(k)]
+
+        table = self.similarities.nearest(k)
+        if self.neighbours_path:
+            saved["tables"][str(k)] = table
+            self.neighbours_path.parent.mkdir(parents=True, exist_ok=True)
+            temporary = self.neighbours_path.with_suffix(".tmp")
+            temporary.write_text(json.dumps(saved))
+            os.replace(temporary, self.neighbours_path)
+        return table
 
     def model_scores(self, model_id, evaluation_model_id):
         scores = [output.score(evaluation_model_id) for output in self.data[model_id]]
         return [score for score in scores if score is not None]
 
-    def model_costs(self, model_id):
-        return [
-            Decimal(item.usage["total_cost"])
-            for item in self.data[model_id]
-            if item.usage
-        ]
+    def average_score(self, model_id, evaluation_model_id):
+        aggregate = self.aggregate(model_id, evaluation_model_id)
+        if not aggregate or not aggregate.score_count:
+            return None
+        return aggregate.score_sum / aggregate.score_count
 
-    def model_evaluation_costs(self, model_id, evaluation_model_id):
-        evaluations = [
-            output.evaluation(evaluation_model_id) for output in self.data[model_id]
-        ]
+    def score_count(self, model_id, evaluation_model_id):
+        aggregate = self.aggregate(model_id, evaluation_model_id)
+        return aggregate.score_count if aggregate else 0
 
-        return [
-            Decimal(evaluation.cost)
-            for evaluation in evaluations
-            if evaluation and evaluation.cost
-        ]
+    def total_cost(self, model_id):
+        aggregate = self.aggregate(model_id)
+        return Decimal(aggregate.cost_micros if aggregate else 0) / MICROS
+
+    def average_cost(self, model_id):
+        return average_cost(self.aggregate(model_id))
+
+    def model_timings(self, model_id, key):
+        timings = [output.timing(key) for output in self.data[model_id]]
+        return [timing for timing in timings if timing is not None]
+
+    def average_evaluation_cost(self, model_id, evaluation_model_id):
+        return average_cost(self.aggregate(model_id, evaluation_model_id))
 
 
 @click.command()
+@click.option("--embedding-model", default="text-embedding-3-small")
 @click.argument("prompt_id")
 @click.argument("pages", nargs=-1)
-def build(prompt_id, pages):
+def build(prompt_id, pages, embedding_model="text-embedding-3-small"):
     survey = SurveyDb()
 
-    prompt_struct = survey.get_prompt_outputs(prompt_id)
+    store = EmbeddingStore(model=embedding_model)
+    store.sync(survey)
+
+    prompt_struct = survey.get_prompt_outputs(prompt_id, embeddings=False)
     if not prompt_struct:
         raise ValueError(f"Prompt {prompt_id!r} does not exist")
 
@@ -63,25 +138,39 @@ def build(prompt_id, pages):
 
     data = prompt_struct.model_outputs
     data = groupby(data, key=lambda x: x.model)
+    # Sorted by id so each model's outputs are one slice of the store.
+    data = {model: sorted(items, key=lambda x: x.id) for model, items in data.items()}
+    vectors = {
+        model: store.vectors([item.id for item in items])
+        for model, items in data.items()
+    }
 
-    outputs = ModelOutputs(data)
+    outputs = ModelOutputs(
+        data,
+        vectors,
+        survey.model_aggregates(prompt_id),
+        embedding_model,
+        neighbours_path=store.directory / f"neighbours-{prompt_id}.json",
+    )
 
     models = sorted(data.keys())
     companies = groupby(models, key=model_company)
     models = sorted(
         data.keys(),
         key=lambda x: (
-            avg(outputs.model_scores(x, prompt_struct.evaluation_model)) or 0,
-            -sum(outputs.model_costs(x)),
+            outputs.average_score(x, prompt_struct.evaluation_model) or 0,
+            -outputs.total_cost(x),
         ),
         reverse=True,
     )
 
-    costs = average_costs(data)
+    costs = {model: outputs.average_cost(model) or Decimal("0.00") for model in data}
 
-    summed_models = outputs.summed_models
-    reference_model = summed_models.get("human/human")
-    consistencies = {model: consistency_measure(items) for model, items in data.items()}
+    # The similarity and rankings pages show every pair, so the full matrix
+    # is built on every run; saved neighbour tables only skip the top-k pass.
+    similarities = outputs.similarities
+    consistencies = {model: outputs.consistency(model) for model in data.keys()}
+    consistency = ConsistencyEngine(vectors)
 
     evaluation_models = sorted(survey.evaluation_models())
 
@@ -125,7 +214,7 @@ def build(prompt_id, pages):
             prompt=prompt,
             marking_scheme=prompt_struct.marking_scheme,
             companies=companies,
-            consistency=consistency_grid(items),
+            consistency=consistency.grid(model),
             GRID_SIZE=len(items),
             outputs=outputs,
             evaluation_models=evaluation_models,
@@ -135,24 +224,31 @@ def build(prompt_id, pages):
         "similarity.html.j2",
         "similarity.html",
         models=models,
-        summed_models=summed_models,
+        similarities=similarities,
     )
 
     render_to_file(
         "consistency.html.j2",
         "consistency.html",
-        data=per_model_consistency(data),
+        data=per_model_consistency(consistency),
         outputs=data,
         GRID_SIZE=3,
     )
 
+    clusters = Clusters.load(clusters_path(store.directory, embedding_model))
+    if clusters:
+        render_to_file(
+            "clusters.html.j2",
+            "clusters.html",
+            families=cluster_families(data, clusters),
+        )
+
     render_to_file(
         "rankings.html.j2",
         "rankings.html",
         models=models,
         prompt=prompt_struct,
-        reference_model=reference_model,
-        summed_models=summed_models,
+        similarities=similarities,
         costs=costs,
         consistencies=consistencies,
         data=data,
@@ -160,31 +256,35 @@ def build(prompt_id, pages):
     )
 
 
-def per_model_consistency(data):
-    data = sorted(data.items(), key=lambda x: consistency_measure(x[1]), reverse=True)
-    return [(model, consistency_grid(items)) for model, items in data]
-
-
-def average_costs(data):
-    result = {}
-    for model, items in data.items():
-        costs = [item.usage["total_cost"] for item in items if item.usage]
-        if not costs:
-            result[model] = Decimal("0.00")
-            continue
-        cost = sum(Decimal(str(cost)) for cost in costs) / len(costs)
-        result[model] = cost
-    return result
+def per_model_consistency(consistency):
+    models = sorted(
+        consistency.slices, key=lambda x: consistency.measure(x) or 0, reverse=True
+    )
+    return [(model, consistency.grid(model)) for model in models]
 
 
-def sum_each_model(grouped):
-    return {
-        model: sum(item.embedding for item in group) for model, group in grouped.items()
-    }
+def cluster_families(data, clusters):
+    # The prompt's outputs grouped by cluster, largest first.
+    items = [item for items in data.values() for item in items]
+    families = groupby(
+        zip(items, clusters.labels_for([item.id for item in items])),
+        key=lambda x: x[1],
+    )
+    families.pop(None, None)
+    return [
+        {
+            "id": label,
+            "size": len(members),
+            "models": Counter(item.model for item, _ in members).most_common(),
+            "example": members[0][0],
+        }
+        for label, members in sorted(
+            families.items(), key=lambda x: len(x[1]), reverse=True
+        )
+    ]
 
 
-def avg(items):
-    if not items:
+def average_cost(aggregate):
+    if not aggregate or not aggregate.cost_count:
         return None
-
-    return sum(items) / len(items)
+    return Decimal(aggregate.cost_micros) / aggregate.cost_count / MICROS
@@ -1,17 +1,105 @@
 import click
 
 from .build import build
-from .embeddings import embeddings
+from .data import ENGINE_PROFILES, SurveyDb
+from .db import db
+from .embeddings import cluster, embeddings
 from .evaluate import evaluate
 from .init import init
+from .logs import logs
 from .models import models
 from .prompts import prompts
+from .query import clients, replay
 from .run import run
+from .similar import similar
 
 
 @click.group()
-def cli():
-    pass
+@click.option("--pool-size", type=click.IntRange(min=1), help="HTTP connection limit.")
+@click.option(
+    "--keepalive",
+    type=click.IntRange(min=0),
+    help="Idle HTTP connections kept open for reuse.",
+)
+@click.option(
+    "--keepalive-expiry",
+    type=float,
+    help="Seconds an idle HTTP connection is kept open.",
+)
+@click.option("--timeout", type=float, help="HTTP request timeout in seconds.")
+@click.option("--http2", is_flag=True, default=None, help="Use HTTP/2 (needs h2).")
+@click.option(
+    "--replay",
+    is_flag=True,
+    envvar="LLM_SURVEY_REPLAY",
+    help="Serve API requests from the request log; fail on a miss.",
+)
+@click.option(
+    "--replay-latency",
+    default="0",
+    envvar="LLM_SURVEY_REPLAY_LATENCY",
+    help="Simulated seconds per replayed request, or 'recorded'.",
+)
+@click.option(
+    "--replay-db",
+    type=click.Path(exists=True, dir_okay=False),
+    envvar="LLM_SURVEY_REPLAY_DB",
+    help="Replay from another survey database.",
+)
+@click.option(
+    "--db-profile",
+    type=click.Choice(sorted(ENGINE_PROFILES)),
+    default="default",
+    envvar="LLM_SURVEY_DB_PROFILE",
+    help="'concurrent' uses WAL and a single writer thread, so several "
+    "survey processes can share survey.db.",
+)
+@click.pass_context
+def cli(
+    ctx,
+    pool_size,
+    keepalive,
+    keepalive_expiry,
+    timeout,
+    http2,
+    replay,
+    replay_latency,
+    replay_db,
+    db_profile,
+):
+    SurveyDb.default_profile = db_profile
+    clients.configure(
+        pool_size=pool_size,
+        keepalive=keepalive,
+        keepalive_expiry=keepalive_expiry,
+        timeout=timeout,
+        http2=http2,
+    )
+    configure_replay(replay, replay_latency, replay_db)
+    ctx.call_on_close(close_clients)
+
+
+def configure_replay(enabled, latency, source):
+    if latency != "recorded":
+        try:
+            latency = float(latency)
+        except ValueError:
+            raise click.BadParameter(
+                "must be a number of seconds or 'recorded'",
+                param_hint="--replay-latency",
+            )
+
+    replay.configure(
+        enabled=enabled,
+        latency=latency,
+        source=SurveyDb(f"sqlite:///{source}") if source else None,
+    )
+
+
+def close_clients():
+    if clients.stats.requests:
+        click.echo(f"HTTP {clients.stats}", err=True)
+    clients.close()
 
 
 cli.add_command(init)
@@ -21,3 +109,7 @@ cli.add_command(evaluate)
 cli.add_command(build)
 cli.add_command(models)
 cli.add_command(prompts)
+cli.add_command(logs)
+cli.add_command(db)
+cli.add_command(similar)
+cli.add_command(cluster)
@@ -0,0 +1,94 @@
+import json
+import re
+import struct
+import zlib
+from collections import Counter
+from pathlib import Path
+
+# zlib only looks back 32KiB, so a larger preset dictionary is wasted.
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+LENGTH = struct.Struct("<I")
+
+
+def encode_payload(request, response, dictionary=None):
+    data = json.dumps({"request": request, "response": response}).encode()
+    if dictionary:
+        compressor = zlib.compressobj(level=9, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level=9)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decode_payload(payload, dictionary=None):
+    if dictionary:
+        decompressor = zlib.decompressobj(zdict=dictionary)
+    else:
+        decompressor = zlib.decompressobj()
+    data = json.loads(decompressor.decompress(payload) + decompressor.flush())
+    return data["request"], data["response"]
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_SIZE):
+    # Keep the JSON keys and runs of text that recur across samples. zlib
+    # prefers matches near the end of the dictionary, so the most valuable
+    # fragments go last.
+    fragments = Counter()
+    for sample in samples:
+        fragments.update(
+            set(re.findall(rb'"[^"\\]{1,48}"\s*:\s*|[^"\\]{8,64}', sample))
+        )
+
+    scored = sorted(
+        (
+            (count * len(fragment), fragment)
+            for fragment, count in fragments.items()
+            if count > 1
+        ),
+        reverse=True,
+    )
+
+    chosen = []
+    total = 0
+    for _, fragment in scored:
+        if total + len(fragment) > size:
+            continue
+        chosen.append(fragment)
+        total += len(fragment)
+
+    return b"".join(reversed(chosen))
+
+
+class SegmentArchive:
+    # Append-only files of length-prefixed compressed payloads.
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+
+    def segments(self):
+        return sorted(self.directory.glob("segment-*.zlog"))
+
+    def current_segment(self):
+        segments = self.segments()
+        if segments and segments[-1].stat().st_size < self.segment_size:
+            return segments[-1]
+        return self.directory / f"segment-{len(segments) + 1:05d}.zlog"
+
+    def append(self, payloads):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segment = self.current_segment()
+        locations = []
+        with open(segment, "ab") as archive:
+            for payload in payloads:
+                locations.append((segment.name, archive.tell()))
+                archive.write(LENGTH.pack(len(payload)))
+                archive.write(payload)
+            archive.flush()
+        return locations
+
+    def read(self, segment, offset):
+        with open(self.directory / segment, "rb") as archive:
+            archive.seek(offset)
+            (length,) = LENGTH.unpack(archive.read(LENGTH.size))
+            return archive.read(length)
@@ -1,17 +1,93 @@
+import asyncio
+import hashlib
 import json
+import queue
 import re
 import textwrap
-from collections import defaultdict
-from datetime import datetime
-from decimal import Decimal
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+from functools import cached_property, partial
+from pathlib import Path
 
 import numpy as np
 import sqlalchemy
-from sqlalchemy import BLOB, JSON, Column, DateTime, ForeignKey, Integer, String
-from sqlalchemy.orm import declarative_base, joinedload, relationship, sessionmaker
+from sqlalchemy import (
+    BLOB,
+    JSON,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    delete,
+    select,
+    text,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import (
+    declarative_base,
+    joinedload,
+    relationship,
+    sessionmaker,
+    validates,
+)
+from sqlalchemy.orm.attributes import set_committed_value
+
+from llm_survey.compression import (
+    SegmentArchive,
+    decode_payload,
+    encode_payload,
+    train_dictionary,
+)
 
 Base = declarative_base()
 
+MICROS = 1_000_000
+
+
+def parse_score(content):
+    if content and (match := re.search(r'"(?:total_)?score":\s*([0-9.]+)', content)):
+        try:
+            return float(match.group(1))
+        except ValueError:
+            return None
+    return None
+
+
+def usage_cost_micros(usage):
+    # Costs are kept as Decimal strings in usage; the column holds whole
+    # micro-dollars so they can be summed in SQL.
+    if not usage or usage.get("total_cost") is None:
+        return None
+    return int(
+        (Decimal(str(usage["total_cost"])) * MICROS).to_integral_value(ROUND_HALF_UP)
+    )
+
+
+def normalise_content(content):
+    # Answers that differ only in whitespace share cached results.
+    return " ".join((content or "").split())
+
+
+def content_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def embedding_key(model, content):
+    return content_key("embedding", model, normalise_content(content))
+
+
+def evaluation_key(evaluator, prompt, marking_scheme, content):
+    return content_key(
+        "evaluation", evaluator, prompt, marking_scheme, normalise_content(content)
+    )
+
 
 class Model(Base):
     __tablename__ = "models"
@@ -57,6 +133,10 @@ class Prompt(Base):
 
 class ModelOutput(Base):
     __tablename__ = "model_outputs"
+    __table_args__ = (
+        Index("ix_model_outputs_prompt_id_model", "prompt_id", "model"),
+        Index("ix_model_outputs_model", "model"),
+    )
 
     id = Column(Integer, primary_key=True)
     content = Column(String)
@@ -64,29 +144,55 @@ class ModelOutput(Base):
     usage = Column(JSON)
     request_id = Column(Integer, ForeignKey("request_logs.id"))
     prompt_id = Column(String, ForeignKey("prompts.id"))
+    cost_micros = Column(Integer, index=True)
 
     prompt = relationship("Prompt", back_populates="model_outputs")
     embeddings = relationship("Embedding", back_populates="model_output")
     evaluations = relationship("Evaluation", back_populates="model_output")
 
+    @validates("usage")
+    def validate_usage(self, key, usage):
+        self.cost_micros = usage_cost_micros(usage)
+        return usage
+
     @property
     def embedding(self):
-        if self.embeddings:
-            return np.frombuffer(self.embeddings[0].embedding)
-        return None
+        if not self.embeddings:
+            return None
+        blob = self.embeddings[0].embedding
+        cached = self.__dict__.get("_embedding")
+        if cached is None or cached[0] is not blob:
+            cached = (blob, self.embeddings[0].vector)
+            self.__dict__["_embedding"] = cached
+        return cached[1]
+
+    @property
+    def evaluations_by_model(self):
+        # Evaluator -> first evaluation, rebuilt when the collection changes.
+        evaluations = self.evaluations
+        cached = self.__dict__.get("_evaluations_by_model")
+        if (
+            cached is None
+            or cached[0] is not evaluations
+            or cached[1] != len(evaluations)
+        ):
+            by_model = {}
+            for evaluation in evaluations:
+                by_model.setdefault(evaluation.model, evaluation)
+            cached = (evaluations, len(evaluations), by_model)
+            self.__dict__["_evaluations_by_model"] = cached
+        return cached[2]
 
     def evaluation(self, model):
-        return next(
-            (
-                evaluation
-                for evaluation in self.evaluations
-                if evaluation.model == model
-            ),
-            None,
-        )
+        return self.evaluations_by_model.get(model)
 
     def has_evaluation(self, evaluator):
-        return any(evaluation.model == evaluator for evaluation in self.evaluations)
+        return evaluator in self.evaluations_by_model
+
+    def timing(self, key):
+        if self.usage:
+            return self.usage.get(key)
+        return None
 
     def score(self, model):
         evaluation = self.evaluation(model)
@@ -119,6 +225,8 @@ class ModelOutput(Base):
                     prompt_tokens * Decimal(pricing["prompt"])
                     + completion_tokens * Decimal(pricing["completion"])
                 ),
+                # Only streamed completions are timed.
+                **completion.get("timing", {}),
             },
             request_id=request_id,
         )
@@ -126,18 +234,69 @@ class ModelOutput(Base):
 
 class Embedding(Base):
     __tablename__ = "embeddings"
+    __table_args__ = (
+        Index("ix_embeddings_output_id_model", "output_id", "model"),
+        Index("ix_embeddings_content_key", "content_key"),
+    )
 
     id = Column(Integer, primary_key=True)
     output_id = Column(Integer, ForeignKey("model_outputs.id"))
     embedding = Column(BLOB)
     model = Column(String)
     request_id = Column(Integer, ForeignKey("request_logs.id"))
+    # NULL for the original float64 rows.
+    dtype = Column(String)
+    scale = Column(Float)
+    content_key = Column(String)
 
     model_output = relationship("ModelOutput", back_populates="embeddings")
 
+    @property
+    def vector(self):
+        return decode_embedding(self.embedding, self.dtype, self.scale)
+
+    @classmethod
+    def from_vector(cls, vector, dtype="float32", **kwargs):
+        blob, scale = encode_embedding(vector, dtype)
+        return cls(embedding=blob, dtype=dtype, scale=scale, **kwargs)
+
+    def copy_for(self, model_output, dtype="float32"):
+        return Embedding.from_vector(
+            self.vector,
+            dtype,
+            output_id=model_output.id,
+            model=self.model,
+            request_id=self.request_id,
+            content_key=self.content_key,
+        )
+
+
+EMBEDDING_DTYPES = ("float64", "float32", "int8")
+
+
+def encode_embedding(vector, dtype="float32"):
+    # Returns (blob, scale). int8 is scalar-quantised with one scale per
+    # vector so that the largest component maps to 127.
+    vector = np.asarray(vector, dtype=np.float64)
+    if dtype == "int8":
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        return np.round(vector / scale).astype(np.int8).tobytes(), scale
+    return vector.astype(dtype).tobytes(), None
+
+
+def decode_embedding(blob, dtype=None, scale=None):
+    if dtype == "int8":
+        return np.frombuffer(blob, dtype=np.int8).astype(np.float32) * np.float32(scale)
+    return np.frombuffer(blob, dtype=dtype or np.float64)
+
 
 class Evaluation(Base):
     __tablename__ = "evaluations"
+    __table_args__ = (
+        Index("ix_evaluations_model_output_id_model", "model_output_id", "model"),
+        Index("ix_evaluations_model", "model"),
+        Index("ix_evaluations_content_key", "content_key"),
+    )
 
     id = Column(Integer, primary_key=True)
     model_output_id = Column(Integer, ForeignKey("model_outputs.id"))
@@ -145,13 +304,22 @@ class Evaluation(Base):
     model = Column(String)
     usage = Column(JSON)
     request_id = Column(Integer, ForeignKey("request_logs.id"))
+    score = Column(Float, index=True)
+    cost_micros = Column(Integer, index=True)
+    # Only set on evaluations with a score, so failures are never reused.
+    content_key = Column(String)
 
     model_output = relationship("ModelOutput", back_populates="evaluations")
 
-    @property
-    def score(self):
-        if match := re.search(r'"(?:total_)?score":\s*([0-9.]+)', self.content):
-            return float(match.group(1))
+    @validates("content")
+    def validate_content(self, key, content):
+        self.score = parse_score(content)
+        return content
+
+    @validates("usage")
+    def validate_usage(self, key, usage):
+        self.cost_micros = usage_cost_micros(usage)
+        return usage
 
     @property
     def cost(self):
@@ -209,35 +377,612 @@ class Evaluation(Base):
             request_id=request_id,
         )
 
+    def copy_for(self, model_output):
+        return Evaluation(
+            model_output_id=model_output.id,
+            content=self.content,
+            model=self.model,
+            usage=self.usage,
+            request_id=self.request_id,
+            content_key=self.content_key,
+        )
+
     def __repr__(self):
         return f"<Evaluation: {self.id!r} model_output={self.model_output_id}>"
 
 
+class ModelAggregate(Base):
+    # Running totals per (prompt, model, evaluator), updated in the same flush
+    # as the rows they summarise. evaluator is "" for the outputs themselves
+    # and "embedding:<model>" for embedding sums.
+    __tablename__ = "model_aggregates"
+
+    prompt_id = Column(String, primary_key=True)
+    model = Column(String, primary_key=True)
+    evaluator = Column(String, primary_key=True)
+    sample_count = Column(Integer, default=0)
+    cost_micros = Column(Integer, default=0)
+    cost_count = Column(Integer, default=0)
+    score_sum = Column(Float, default=0.0)
+    score_count = Column(Integer, default=0)
+    embedding_sum = Column(BLOB)
+    unit_embedding_sum = Column(BLOB)
+
+    @classmethod
+    def empty(cls, prompt_id, model, evaluator):
+        return cls(
+            prompt_id=prompt_id,
+            model=model,
+            evaluator=evaluator,
+            sample_count=0,
+            cost_micros=0,
+            cost_count=0,
+            score_sum=0.0,
+            score_count=0,
+        )
+
+    @property
+    def embedding(self):
+        if self.embedding_sum is None:
+            return None
+        return np.frombuffer(self.embedding_sum)
+
+    def add(self, cost_micros=None, score=None, embedding=None):
+        self.sample_count += 1
+        if cost_micros is not None:
+            self.cost_micros += cost_micros
+            self.cost_count += 1
+        if score is not None:
+            self.score_sum += score
+            self.score_count += 1
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float64)
+            norm = np.linalg.norm(vector)
+            self.embedding_sum = add_vector(self.embedding_sum, vector)
+            self.unit_embedding_sum = add_vector(
+                self.unit_embedding_sum, vector / norm if norm else vector
+            )
+
+    def consistency(self):
+        # The mean cosine similarity between each vector and their sum S is
+        # sum_i S.v_i / (n |S| |v_i|) = S.U / (n |S|), with U the sum of the
+        # unit vectors.
+        if self.embedding_sum is None:
+            return None
+        total = np.frombuffer(self.embedding_sum)
+        units = np.frombuffer(self.unit_embedding_sum)
+        return float(total @ units / (self.sample_count * np.linalg.norm(total)))
+
+
+def add_vector(blob, vector):
+    if blob is None:
+        return vector.astype(np.float64).tobytes()
+    return (np.frombuffer(blob) + vector).tobytes()
+
+
+def aggregate_key(output, evaluator):
+    return (output.prompt_id or "", output.model, evaluator)
+
+
+def is_first(session, counted, column, model_column, output_id, model):
+    # Only the first embedding or evaluation of an output by each model is
+    # counted, matching ModelOutput.embedding and ModelOutput.evaluation.
+    key = (column, output_id, model)
+    if key in counted:
+        return False
+    counted.add(key)
+    return (
+        session.scalar(
+            select(column).where(column == output_id, model_column == model).limit(1)
+        )
+        is None
+    )
+
+
+def lock_for_write(session):
+    # pysqlite only sends BEGIN before the first INSERT or UPDATE, so reads
+    # made before then are outside the transaction. Taking the write lock
+    # first makes the read-modify-write below atomic across processes.
+    connection = session.connection()
+    if connection.dialect.name != "sqlite":
+        return
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def update_model_aggregates(session, flush_context, instances):
+    if not any(
+        isinstance(obj, (ModelOutput, Evaluation, Embedding)) for obj in session.new
+    ):
+        return
+
+    updates = []
+    counted = set()
+    with session.no_autoflush:
+        lock_for_write(session)
+        for obj in list(session.new):
+            if isinstance(obj, ModelOutput):
+                updates.append(
+                    (aggregate_key(obj, ""), {"cost_micros": obj.cost_micros})
+                )
+            elif isinstance(obj, Evaluation):
+                output = obj.model_output or session.get(
+                    ModelOutput, obj.model_output_id
+                )
+                if output is None or not is_first(
+                    session,
+                    counted,
+                    Evaluation.model_output_id,
+                    Evaluation.model,
+                    output.id,
+                    obj.model,
+                ):
+                    continue
+                updates.append(
+                    (
+                        aggregate_key(output, obj.model),
+                        {"cost_micros": obj.cost_micros, "score": obj.score},
+                    )
+                )
+            elif isinstance(obj, Embedding):
+                output = obj.model_output or session.get(ModelOutput, obj.output_id)
+                if output is None or not is_first(
+                    session,
+                    counted,
+                    Embedding.output_id,
+                    Embedding.model,
+                    output.id,
+                    obj.model,
+                ):
+                    continue
+                updates.append(
+                    (
+                        aggregate_key(output, f"embedding:{obj.model}"),
+                        {"embedding": obj.vector},
+                    )
+                )
+
+        # Sum this flush's changes, then add them to the stored totals.
+        deltas = {}
+        for key, values in updates:
+            if key not in deltas:
+                deltas[key] = ModelAggregate.empty(*key)
+            deltas[key].add(**values)
+
+        for delta in deltas.values():
+            add_to_aggregate(session, delta)
+
+
+AGGREGATE_TOTALS = (
+    "sample_count",
+    "cost_micros",
+    "cost_count",
+    "score_sum",
+    "score_count",
+)
+
+
+def add_to_aggregate(session, delta):
+    table = ModelAggregate.__table__
+    key = {
+        "prompt_id": delta.prompt_id,
+        "model": delta.model,
+        "evaluator": delta.evaluator,
+    }
+    insert_totals = sqlite_insert(table).values(
+        **key, **{column: getattr(delta, column) for column in AGGREGATE_TOTALS}
+    )
+    session.execute(
+        insert_totals.on_conflict_do_update(
+            index_elements=list(key),
+            set_={
+                column: table.c[column] + insert_totals.excluded[column]
+                for column in AGGREGATE_TOTALS
+            },
+        )
+    )
+
+    if delta.embedding_sum is None:
+        return
+    where = [table.c[column] == value for column, value in key.items()]
+    embedding_sum, unit_embedding_sum = session.execute(
+        select(table.c.embedding_sum, table.c.unit_embedding_sum).where(*where)
+    ).one()
+    session.execute(
+        table.update()
+        .where(*where)
+        .values(
+            embedding_sum=add_vector(embedding_sum, np.frombuffer(delta.embedding_sum)),
+            unit_embedding_sum=add_vector(
+                unit_embedding_sum, np.frombuffer(delta.unit_embedding_sum)
+            ),
+        )
+    )
+
+
+def rebuild_model_aggregates(session):
+    session.execute(delete(ModelAggregate))
+
+    aggregates = {}
+
+    def aggregate(key):
+        if key not in aggregates:
+            aggregates[key] = ModelAggregate.empty(*key)
+        return aggregates[key]
+
+    prompt_id = sqlalchemy.func.coalesce(ModelOutput.prompt_id, "")
+    for key_prompt, model, count, cost, cost_count in session.execute(
+        select(
+            prompt_id,
+            ModelOutput.model,
+            sqlalchemy.func.count(ModelOutput.id),
+            sqlalchemy.func.sum(ModelOutput.cost_micros),
+            sqlalchemy.func.count(ModelOutput.cost_micros),
+        ).group_by(prompt_id, ModelOutput.model)
+    ):
+        row = aggregate((key_prompt, model, ""))
+        row.sample_count = count
+        row.cost_micros = cost or 0
+        row.cost_count = cost_count
+
+    first_evaluations = select(sqlalchemy.func.min(Evaluation.id)).group_by(
+        Evaluation.model_output_id, Evaluation.model
+    )
+    for (
+        key_prompt,
+        model,
+        evaluator,
+        count,
+        score,
+        score_count,
+        cost,
+        cost_count,
+    ) in session.execute(
+        select(
+            prompt_id,
+            ModelOutput.model,
+            Evaluation.model,
+            sqlalchemy.func.count(Evaluation.id),
+            sqlalchemy.func.sum(Evaluation.score),
+            sqlalchemy.func.count(Evaluation.score),
+            sqlalchemy.func.sum(Evaluation.cost_micros),
+            sqlalchemy.func.count(Evaluation.cost_micros),
+        )
+        .join(ModelOutput, Evaluation.model_output_id == ModelOutput.id)
+        .where(Evaluation.id.in_(first_evaluations))
+        .group_by(prompt_id, ModelOutput.model, Evaluation.model)
+    ):
+        row = aggregate((key_prompt, model, evaluator))
+        row.sample_count = count
+        row.score_sum = score or 0.0
+        row.score_count = score_count
+        row.cost_micros = cost or 0
+        row.cost_count = cost_count
+
+    first_embeddings = select(sqlalchemy.func.min(Embedding.id)).group_by(
+        Embedding.output_id, Embedding.model
+    )
+    for key_prompt, model, embedding_model, blob, dtype, scale in session.execute(
+        select(
+            prompt_id,
+            ModelOutput.model,
+            Embedding.model,
+            Embedding.embedding,
+            Embedding.dtype,
+            Embedding.scale,
+        )
+        .join(ModelOutput, Embedding.output_id == ModelOutput.id)
+        .where(Embedding.id.in_(first_embeddings))
+        .execution_options(yield_per=1000)
+    ):
+        aggregate((key_prompt, model, f"embedding:{embedding_model}")).add(
+            embedding=decode_embedding(blob, dtype, scale)
+        )
+
+    session.add_all(aggregates.values())
+    return len(aggregates)
+
+
 class RequestLog(Base):
     __tablename__ = "request_logs"
 
     id = Column(Integer, primary_key=True)
     time = Column(DateTime, default=datetime.utcnow)
     resource = Column(String)
+    # Uncompressed rows keep the request and response as JSON. Compressed
+    # rows hold both in payload, or in an archive segment once archived.
     request = Column(JSON)
     response = Column(JSON)
+    request_hash = Column(String, index=True)
+    payload = Column(BLOB)
+    compression = Column(String)
+    segment = Column(String)
+    segment_offset = Column(Integer)
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    time = Column(DateTime, default=datetime.utcnow)
+
+
+class CompressionDictionary(Base):
+    __tablename__ = "compression_dictionaries"
+
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, default=datetime.utcnow)
+    data = Column(BLOB)
+
+
+def request_key(resource, request):
+    canonical = json.dumps([resource, request], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    # The earliest stored embedding or evaluation for each content key,
+    # looked up a batch of keys at a time. Only rows read from the database
+    # are kept, and only the most recently used; results made during a run
+    # are the caller's to track.
+    def __init__(self, survey, cls, maxsize=1024):
+        self.survey = survey
+        self.cls = cls
+        self.rows = LruCache(maxsize)
+
+    def find(self, keys):
+        found = {}
+        for key in keys:
+            if (row := self.rows.get(key)) is not None:
+                found[key] = row
+        unknown = [key for key in dict.fromkeys(keys) if key not in found]
+        for key, row in self.survey.find_by_content_keys(self.cls, unknown).items():
+            self.rows.put(key, row)
+            found[key] = row
+        return found
+
+
+def dedup_summary(reused, total):
+    rate = reused / total if total else 0
+    return f"Reused {reused} of {total} results ({rate:.0%})"
+
+
+class LruCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+class BatchWriter:
+    # Collects inserts and commits them together, once size rows are pending
+    # or interval seconds have passed since the last commit. With a plain
+    # `with` the interval is only checked on insert; `async with` also runs a
+    # task that commits every interval, so rows don't wait on slow requests.
+    # Leaving either block, even on Ctrl-C, commits whatever is left.
+    def __init__(self, survey, size=100, interval=0.5):
+        self.survey = survey
+        self.size = size
+        self.interval = interval
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def insert(self, obj):
+        self.pending.append(obj)
+        if (
+            len(self.pending) >= self.size
+            or time.monotonic() - self.last_flush >= self.interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            pending = self.pending
+            self.pending = []
+
+            def add_all(session):
+                session.add_all(pending)
+                session.commit()
+
+            self.survey.write(add_all)
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.last_flush + self.interval - time.monotonic())
+            if time.monotonic() - self.last_flush >= self.interval:
+                self.flush()
+
+    async def __aenter__(self):
+        self.flusher = asyncio.ensure_future(self.flush_periodically())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.flusher.cancel()
+        try:
+            await self.flusher
+        except asyncio.CancelledError:
+            pass
+        self.flush()
+
+
+class WriterThread:
+    # Runs every write on one thread and connection, so writes from this
+    # process never contend with each other for the SQLite lock.
+    def __init__(self, Session):
+        self.Session = Session
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.work, name="survey-db-writer", daemon=True
+        )
+        self.thread.start()
+
+    def work(self):
+        while (item := self.queue.get()) is not None:
+            operation, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with self.Session() as session:
+                    future.set_result(operation(session))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    def submit(self, operation):
+        future = Future()
+        self.queue.put((operation, future))
+        return future.result()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+ENGINE_PROFILES = {
+    "default": {
+        "pragmas": {},
+        "single_writer": False,
+    },
+    # Several processes can share one database: readers don't block the
+    # writer under WAL, and writers wait for the lock instead of failing.
+    "concurrent": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 60_000,
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,
+            "temp_store": "MEMORY",
+        },
+        "single_writer": True,
+    },
+}
+
+
+def set_sqlite_pragmas(pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    return on_connect
 
 
 class SurveyDb:
-    def __init__(self, db_url="sqlite:///survey.db"):
+    default_profile = "default"
+
+    def __init__(
+        self,
+        db_url="sqlite:///survey.db",
+        archive_dir="request_archive",
+        profile=None,
+    ):
+        profile = ENGINE_PROFILES[profile or self.default_profile]
+
         self.engine = sqlalchemy.create_engine(db_url)
+        if profile["pragmas"]:
+            sqlalchemy.event.listen(
+                self.engine, "connect", set_sqlite_pragmas(profile["pragmas"])
+            )
         self.Session = sessionmaker(bind=self.engine)
+        sqlalchemy.event.listen(self.Session, "before_flush", update_model_aggregates)
+        self.writer = WriterThread(self.Session) if profile["single_writer"] else None
+        self.request_cache = LruCache()
+        self.archive = SegmentArchive(Path(archive_dir))
+        self.dictionaries = {}
+
+    def write(self, operation):
+        if self.writer:
+            return self.writer.submit(operation)
+        with self.Session() as session:
+            return operation(session)
+
+    def write_batches(self, operation):
+        # Repeats a write that returns how many rows it handled until it
+        # handles none. Returns the total.
+        count = 0
+        while handled := self.write(operation):
+            count += handled
+        return count
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        self.engine.dispose()
 
     def create_tables(self):
         Base.metadata.create_all(self.engine)
+        return self.upgrade()
 
-    def insert(self, obj):
+    def upgrade(self):
+        from llm_survey.migrations import MIGRATIONS
+
+        with self.Session() as session:
+            applied = set(session.scalars(select(SchemaMigration.version)))
+
+        upgraded = []
+        for version, description, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            self.write(
+                partial(
+                    self.apply_migration,
+                    version=version,
+                    description=description,
+                    migrate=migrate,
+                )
+            )
+            upgraded.append((version, description))
+        return upgraded
+
+    def apply_migration(self, session, version, description, migrate):
+        connection = session.connection()
+        migrate(connection)
+        connection.execute(
+            SchemaMigration.__table__.insert().values(
+                version=version,
+                description=description,
+                time=datetime.utcnow(),
+            )
+        )
+        session.commit()
+
+    def schema_version(self):
         with self.Session() as session:
+            return session.scalar(select(sqlalchemy.func.max(SchemaMigration.version)))
+
+    def insert(self, obj):
+        def add(session):
             session.add(obj)
             session.commit()
 
+        self.write(add)
+
+    def batch(self, size=100, interval=0.5):
+        return BatchWriter(self, size, interval)
+
     def save_prompt(self, prompt):
-        with self.Session() as session:
+        def save(session):
             old_prompt = session.get(Prompt, prompt["id"])
             if old_prompt is None:
                 session.add(Prompt(**prompt))
@@ -246,12 +991,16 @@ class SurveyDb:
                     setattr(old_prompt, key, value)
             session.commit()
 
+        self.write(save)
+
     def delete_prompt(self, prompt_id):
-        with self.Session() as session:
+        def delete(session):
             prompt = session.get(Prompt, prompt_id)
             session.delete(prompt)
             session.commit()
 
+        self.write(delete)
+
     def get_model_output(self, output_id):
         with self.Session() as session:
             return session.get(
@@ -275,20 +1024,159 @@ class SurveyDb:
         with self.Session() as session:
             return session.get(Prompt, prompt_id)
 
-    def get_prompt_outputs(self, prompt_id):
+    def get_prompt_outputs(self, prompt_id, embeddings=True):
+        # Pass embeddings=False when the vectors come from an EmbeddingStore.
         with self.Session() as session:
             return session.get(
                 Prompt,
                 prompt_id,
                 options=[
                     joinedload(Prompt.model_outputs),
-                    joinedload(Prompt.model_outputs).joinedload(ModelOutput.embeddings),
+                    (
+                        joinedload(Prompt.model_outputs).joinedload(
+                            ModelOutput.embeddings
+                        )
+                        if embeddings
+                        else joinedload(Prompt.model_outputs).raiseload(
+                            ModelOutput.embeddings
+                        )
+                    ),
                     joinedload(Prompt.model_outputs).joinedload(
                         ModelOutput.evaluations
                     ),
                 ],
             )
 
+    def recode_embeddings(self, dtype, batch_size=1000):
+        # Rewrites every embedding stored in another type. Returns the number
+        # of rows changed.
+        def recode(session):
+            embeddings = session.scalars(
+                select(Embedding)
+                .where(sqlalchemy.func.coalesce(Embedding.dtype, "float64") != dtype)
+                .limit(batch_size)
+            ).all()
+            for embedding in embeddings:
+                embedding.embedding, embedding.scale = encode_embedding(
+                    embedding.vector, dtype
+                )
+                embedding.dtype = dtype
+            session.commit()
+            return len(embeddings)
+
+        return self.write_batches(recode)
+
+    def output_counts(self, prompt_id):
+        with self.Session() as session:
+            return dict(
+                session.execute(
+                    select(ModelOutput.model, sqlalchemy.func.count(ModelOutput.id))
+                    .where(ModelOutput.prompt_id == prompt_id)
+                    .group_by(ModelOutput.model)
+                ).all()
+            )
+
+    def outputs_missing_embedding(self, model):
+        with self.Session() as session:
+            return session.scalars(
+                select(ModelOutput.id)
+                .where(
+                    ~select(Embedding.id)
+                    .where(
+                        Embedding.output_id == ModelOutput.id, Embedding.model == model
+                    )
+                    .exists()
+                )
+                .order_by(ModelOutput.id)
+            ).all()
+
+    def outputs_missing_evaluation(self, prompt_id, evaluator, models=(), limit=None):
+        # models matches on substrings of the model id, like evaluate -m.
+        query = (
+            select(ModelOutput.id)
+            .where(
+                ModelOutput.prompt_id == prompt_id,
+                ~select(Evaluation.id)
+                .where(
+                    Evaluation.model_output_id == ModelOutput.id,
+                    Evaluation.model == evaluator,
+                )
+                .exists(),
+            )
+            .order_by(ModelOutput.id)
+        )
+        if models:
+            query = query.where(
+                sqlalchemy.or_(
+                    *(
+                        ModelOutput.model.contains(model, autoescape=True)
+                        for model in models
+                    )
+                )
+            )
+        if limit:
+            query = query.limit(limit)
+
+        with self.Session() as session:
+            return session.scalars(query).all()
+
+    def output_contents(self, batch_size=1000):
+        with self.Session() as session:
+            yield from session.scalars(
+                select(ModelOutput.content)
+                .order_by(ModelOutput.id)
+                .execution_options(yield_per=batch_size)
+            )
+
+    def find_by_content_keys(self, cls, keys, batch_size=500):
+        # The earliest row for each key that has one.
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), batch_size):
+            earliest = (
+                select(sqlalchemy.func.min(cls.id))
+                .where(cls.content_key.in_(keys[start : start + batch_size]))
+                .group_by(cls.content_key)
+            )
+            with self.Session() as session:
+                for row in session.scalars(select(cls).where(cls.id.in_(earliest))):
+                    found[row.content_key] = row
+        return found
+
+    def model_output_batches(self, ids, batch_size=500):
+        # Loads a batch at a time and closes the session before yielding, so
+        # no read transaction is held open while the caller writes.
+        for start in range(0, len(ids), batch_size):
+            with self.Session() as session:
+                outputs = session.scalars(
+                    select(ModelOutput)
+                    .where(ModelOutput.id.in_(ids[start : start + batch_size]))
+                    .order_by(ModelOutput.id)
+                ).all()
+            yield outputs
+
+    def stream_model_outputs(self, ids, batch_size=500):
+        for outputs in self.model_output_batches(ids, batch_size):
+            yield from outputs
+
+    def embedding_rows(self, model, after_id=0, batch_size=1000):
+        with self.Session() as session:
+            yield from session.execute(
+                select(
+                    Embedding.id,
+                    Embedding.output_id,
+                    ModelOutput.prompt_id,
+                    ModelOutput.model,
+                    Embedding.embedding,
+                    Embedding.dtype,
+                    Embedding.scale,
+                )
+                .join(ModelOutput, Embedding.output_id == ModelOutput.id)
+                .where(Embedding.model == model, Embedding.id > after_id)
+                .order_by(Embedding.id)
+                .execution_options(yield_per=batch_size)
+            )
+
     def model_outputs(self):
         with self.Session() as session:
             return (
@@ -307,33 +1195,203 @@ class SurveyDb:
             return session.query(Prompt).all()
 
     def log_request(self, resource, request, response):
-        with self.Session() as session:
+        dictionary = self.current_dictionary
+
+        def log(session):
             log = RequestLog(
                 resource=resource,
-                request=request,
-                response=response,
+                request_hash=request_key(resource, request),
+                payload=encode_payload(
+                    request, response, dictionary.data if dictionary else None
+                ),
+                compression=compression_name(dictionary),
             )
             session.add(log)
             session.commit()
             return log.id
 
+        return self.write(log)
+
     def get_logged_request(self, resource, request):
+        key = request_key(resource, request)
+        if log := self.request_cache.get(key):
+            return log
+
         with self.Session() as session:
-            return (
-                session.query(RequestLog)
-                .filter_by(resource=resource, request=json.dumps(request))
-                .first()
-            )
+            log = session.query(RequestLog).filter_by(request_hash=key).first()
+            if log:
+                self.decode_log(session, log)
+
+        if log:
+            self.request_cache.put(key, log)
+        return log
+
+    def decode_log(self, session, log):
+        if not log.compression:
+            return log
+
+        payload = log.payload
+        if payload is None:
+            payload = self.archive.read(log.segment, log.segment_offset)
+
+        request, response = decode_payload(
+            payload, self.dictionary_data(session, log.compression)
+        )
+        set_committed_value(log, "request", request)
+        set_committed_value(log, "response", response)
+        return log
+
+    @cached_property
+    def current_dictionary(self):
+        # Read once, then replaced by train_compression_dictionary, so
+        # log_request doesn't query for it on every request. A dictionary
+        # trained by another process is picked up on the next start.
+        with self.Session() as session:
+            return session.scalars(
+                select(CompressionDictionary)
+                .order_by(CompressionDictionary.id.desc())
+                .limit(1)
+            ).first()
+
+    def dictionary_data(self, session, compression):
+        _, _, dictionary_id = compression.partition(":")
+        if not dictionary_id:
+            return None
+
+        dictionary_id = int(dictionary_id)
+        if dictionary_id not in self.dictionaries:
+            self.dictionaries[dictionary_id] = session.get(
+                CompressionDictionary, dictionary_id
+            ).data
+        return self.dictionaries[dictionary_id]
+
+    def train_compression_dictionary(self, samples=1000, size=None):
+        with self.Session() as session:
+            logs = session.scalars(
+                select(RequestLog).order_by(RequestLog.id.desc()).limit(samples)
+            ).all()
+            payloads = [
+                json.dumps({"request": log.request, "response": log.response}).encode()
+                for log in (self.decode_log(session, log) for log in logs)
+            ]
+
+        options = {"size": size} if size else {}
+        data = train_dictionary(payloads, **options)
+
+        def save(session):
+            dictionary = CompressionDictionary(data=data)
+            session.add(dictionary)
+            session.commit()
+            return dictionary.id
+
+        dictionary_id = self.write(save)
+        self.current_dictionary = CompressionDictionary(id=dictionary_id, data=data)
+        return dictionary_id, len(data)
+
+    def compress_request_logs(self, batch_size=1000):
+        # One write per batch, so other writers can run in between.
+        dictionary = self.current_dictionary
+
+        def compress(session):
+            logs = session.scalars(
+                select(RequestLog)
+                .where(RequestLog.compression.is_(None))
+                .limit(batch_size)
+            ).all()
+            for log in logs:
+                log.request_hash = log.request_hash or request_key(
+                    log.resource, log.request
+                )
+                log.payload = encode_payload(
+                    log.request,
+                    log.response,
+                    dictionary.data if dictionary else None,
+                )
+                log.compression = compression_name(dictionary)
+                log.request = None
+                log.response = None
+            session.commit()
+            return len(logs)
+
+        return self.write_batches(compress)
+
+    def archive_request_logs(self, older_than=timedelta(days=30), batch_size=1000):
+        cutoff = datetime.utcnow() - older_than
+
+        def archive(session):
+            logs = session.scalars(
+                select(RequestLog)
+                .where(
+                    RequestLog.time < cutoff,
+                    RequestLog.payload.is_not(None),
+                )
+                .limit(batch_size)
+            ).all()
+            if not logs:
+                return 0
+
+            # The segment is written before the rows point at it, so a
+            # crash can only leave unreferenced bytes in the archive.
+            locations = self.archive.append([log.payload for log in logs])
+            for log, (segment, offset) in zip(logs, locations):
+                log.segment = segment
+                log.segment_offset = offset
+                log.payload = None
+            session.commit()
+            return len(logs)
+
+        return self.write_batches(archive)
+
+    def vacuum(self):
+        with self.engine.connect() as connection:
+            connection.execute(text("VACUUM"))
+
+    def backfill_request_hashes(self, batch_size=1000):
+        def backfill(session):
+            logs = session.scalars(
+                select(RequestLog)
+                .where(RequestLog.request_hash.is_(None))
+                .limit(batch_size)
+            ).all()
+            for log in logs:
+                self.decode_log(session, log)
+                log.request_hash = request_key(log.resource, log.request)
+            session.commit()
+            return len(logs)
+
+        return self.write_batches(backfill)
+
+    def embedding_models(self):
+        with self.Session() as session:
+            return set(session.scalars(select(Embedding.model).distinct()))
 
     def evaluation_models(self):
+        with self.Session() as session:
+            return set(session.scalars(select(Evaluation.model).distinct()))
+
+    def model_aggregates(self, prompt_id):
         with self.Session() as session:
             return {
-                evaluation.model
-                for evaluation in session.query(Evaluation)
-                .distinct(Evaluation.model)
-                .all()
+                (aggregate.model, aggregate.evaluator): aggregate
+                for aggregate in session.scalars(
+                    select(ModelAggregate).where(ModelAggregate.prompt_id == prompt_id)
+                )
             }
 
+    def rebuild_aggregates(self):
+        def rebuild(session):
+            count = rebuild_model_aggregates(session)
+            session.commit()
+            return count
+
+        return self.write(rebuild)
+
+
+def compression_name(dictionary):
+    if dictionary is None:
+        return "zlib"
+    return f"zlib:{dictionary.id}"
+
 
 def groupby(data, key):
     result = defaultdict(list)
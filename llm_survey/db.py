@@ -0,0 +1,50 @@
+import click
+
+from llm_survey.data import EMBEDDING_DTYPES, SurveyDb
+from llm_survey.store import EmbeddingStore, LshIndex
+
+
+@click.group
+def db():
+    pass
+
+
+@db.command
+def upgrade():
+    survey = SurveyDb()
+
+    for version, description in survey.create_tables():
+        click.echo(f"Applied {version}: {description}")
+    click.echo(f"Schema version {survey.schema_version()}.")
+
+
+@db.command("rebuild-aggregates")
+def rebuild_aggregates():
+    survey = SurveyDb()
+
+    count = survey.rebuild_aggregates()
+    click.echo(f"Rebuilt {count} model aggregates.")
+
+
+@db.command("compact-embeddings")
+@click.option(
+    "--dtype",
+    default="float32",
+    type=click.Choice(EMBEDDING_DTYPES),
+)
+@click.option("--vacuum", is_flag=True, help="Reclaim the freed space afterwards.")
+def compact_embeddings(dtype="float32", vacuum=False):
+    survey = SurveyDb()
+
+    count = survey.recode_embeddings(dtype)
+    click.echo(f"Stored {count} embeddings as {dtype}.")
+    if count:
+        # The totals and stores hold copies of the old vectors.
+        survey.rebuild_aggregates()
+        for model in sorted(survey.embedding_models()):
+            store = EmbeddingStore(model=model)
+            store.sync(survey, rebuild=True)
+            LshIndex(model=model).sync(store, rebuild=True)
+        click.echo("Rebuilt model aggregates and embedding stores.")
+    if vacuum:
+        survey.vacuum()
@@ -1,41 +1,135 @@
+from pathlib import Path
+
 import click
 from tqdm import tqdm
 
-from llm_survey.data import Embedding, SurveyDb
-from llm_survey.query import embed_content
+from llm_survey.data import (
+    EMBEDDING_DTYPES,
+    Embedding,
+    SurveyDb,
+    dedup_summary,
+    embedding_key,
+    normalise_content,
+)
+from llm_survey.query import embedding_backend
+from llm_survey.store import EmbeddingStore, LshIndex
 from llm_survey.templating import template_filter
 
 
 @click.command()
-@click.option("--model", "-m", default="text-embedding-3-small")
+@click.option(
+    "--model",
+    "-m",
+    default="text-embedding-3-small",
+    help="OpenAI embedding model, or local/hashed-ngrams to embed on this machine.",
+)
 @click.option("--dry-run", "-n", is_flag=True)
-def embeddings(model, dry_run=False):
-    import numpy as np
-
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    help="Maximum number of distinct texts per embedding request"
+    " (default 256, or 1024 for local models).",
+)
+@click.option(
+    "--batch-tokens",
+    type=click.IntRange(min=1),
+    help="Approximate token budget per embedding request (default 100000).",
+)
+@click.option(
+    "--dtype",
+    default="float32",
+    type=click.Choice(EMBEDDING_DTYPES),
+    help="Storage type for new vectors; int8 is quantised with a per-vector scale.",
+)
+def embeddings(
+    model, dry_run=False, batch_size=None, batch_tokens=None, dtype="float32"
+):
     survey = SurveyDb()
+    backend = embedding_backend(model)
 
-    it = tqdm(list(survey.model_outputs()), unit="outputs")
-    for output in it:
-        it.set_postfix(model=output.model, id=output.id)
-        if output.embedding is not None:
-            continue
-        it.write(f"Generate embedding for: {output.id} {output.model}")
+    pending = survey.outputs_missing_embedding(model)
+    reused = 0
 
-        if dry_run:
-            continue
+    it = tqdm(total=len(pending), unit="outputs")
+    with survey.batch() as writer:
+        for batch in batch_outputs(
+            survey.stream_model_outputs(pending),
+            batch_size or backend.batch_size,
+            batch_tokens or backend.batch_tokens,
+        ):
+            outputs = [output for _, group in batch for output in group]
+            keys = [embedding_key(model, content) for content, _ in batch]
+            # batch_outputs already merges equal texts, so a vector made for
+            # this batch is never needed by a later one.
+            found = survey.find_by_content_keys(Embedding, keys)
+            missing = [
+                (key, content)
+                for key, (content, _) in zip(keys, batch)
+                if key not in found
+            ]
+            reused += len(outputs) - len(missing)
 
-        request_id, embedding_vector = embed_content(
-            survey, output.content, model=model
-        )
+            for output in outputs:
+                it.write(f"Generate embedding for: {output.id} {output.model}")
 
-        survey.insert(
-            Embedding(
-                output_id=output.id,
-                model=model,
-                embedding=embedding_vector,
-                request_id=request_id,
-            )
-        )
+            if not dry_run:
+                if missing:
+                    request_id, vectors = backend.embed(
+                        survey, [content for _, content in missing], model
+                    )
+                    for (key, _), embedding_vector in zip(missing, vectors):
+                        found[key] = Embedding.from_vector(
+                            embedding_vector,
+                            "float64",
+                            model=model,
+                            request_id=request_id,
+                            content_key=key,
+                        )
+
+                for key, (_, group) in zip(keys, batch):
+                    for output in group:
+                        writer.insert(found[key].copy_for(output, dtype))
+
+            it.set_postfix(model=outputs[-1].model, id=outputs[-1].id)
+            it.update(len(outputs))
+    it.close()
+    print(dedup_summary(reused, len(pending)))
+
+    if not dry_run:
+        store = EmbeddingStore(model=model)
+        store.sync(survey)
+        LshIndex(model=model).sync(store)
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text.
+    return len(text) // 4 + 1
+
+
+def batch_outputs(outputs, batch_size, batch_tokens):
+    # Yields lists of (content, outputs) pairs, one pair per distinct text
+    # once whitespace is normalised. A text larger than batch_tokens is sent
+    # on its own.
+    by_content = {}
+    for output in outputs:
+        by_content.setdefault(normalise_content(output.content), []).append(output)
+
+    batch = []
+    tokens = 0
+    for group in by_content.values():
+        content = group[0].content
+        content_tokens = estimate_tokens(content)
+        if batch and (
+            len(batch) >= batch_size or tokens + content_tokens > batch_tokens
+        ):
+            yield batch
+            batch = []
+            tokens = 0
+        batch.append((content, group))
+        tokens += content_tokens
+
+    if batch:
+        yield batch
 
 
 @template_filter()
@@ -47,20 +141,256 @@ def similarity(a, b):
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
 
-def consistency_measure(model_outputs):
-    if any(output.embedding is None for output in model_outputs):
-        return None
+class SimilarityMatrix:
+    # Cosine similarity between every pair of labelled vectors, computed with
+    # one matrix multiply per block of rows. Missing vectors compare as 0,
+    # like the similarity filter.
+    def __init__(self, labels, vectors, block_size=1024):
+        import numpy as np
+
+        self.labels = list(labels)
+        self.index = {label: i for i, label in enumerate(self.labels)}
+
+        dimensions = next((len(v) for v in vectors if v is not None), 0)
+        unit = np.zeros((len(self.labels), dimensions), dtype=np.float32)
+        for i, vector in enumerate(vectors):
+            if vector is not None:
+                unit[i] = vector
+        norms = np.linalg.norm(unit, axis=1, keepdims=True)
+        np.divide(unit, norms, out=unit, where=norms > 0)
+
+        self.matrix = np.empty((len(self.labels), len(self.labels)), dtype=np.float32)
+        for start in range(0, len(self.labels), block_size):
+            np.matmul(
+                unit[start : start + block_size],
+                unit.T,
+                out=self.matrix[start : start + block_size],
+            )
+        self.rows = self.matrix.tolist()
+
+    def __getitem__(self, pair):
+        a, b = pair
+        if a not in self.index or b not in self.index:
+            return 0
+        return self.rows[self.index[a]][self.index[b]]
+
+    def row(self, label, labels):
+        # Similarities from `label` to each of `labels`, in that order.
+        row = self.rows[self.index[label]] if label in self.index else []
+        return [
+            row[self.index[other]] if other in self.index else 0 for other in labels
+        ]
+
+    def nearest(self, k):
+        # The k most similar other labels for every label, best first.
+        import numpy as np
+
+        k = min(k, len(self.labels) - 1)
+        if k <= 0:
+            return {label: [] for label in self.labels}
+
+        scores = self.matrix.copy()
+        np.fill_diagonal(scores, -np.inf)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.take_along_axis(-scores, top, axis=1).argsort(axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        return {
+            label: [self.labels[j] for j in row]
+            for label, row in zip(self.labels, top.tolist())
+        }
+
+
+class ConsistencyEngine:
+    # Stacks every output's embedding once, grouped by model. Each model's
+    # Gram block of cosine similarities and its consistency score are
+    # computed on first use and cached for the rest of the build. Missing
+    # embeddings compare as 0 and leave the model's consistency undefined.
+    def __init__(self, groups):
+        import numpy as np
+
+        self.slices = {}
+        start = 0
+        for model, vectors in groups.items():
+            self.slices[model] = slice(start, start + len(vectors))
+            start += len(vectors)
+
+        dimensions = next(
+            (len(v) for vectors in groups.values() for v in vectors if v is not None),
+            0,
+        )
+        self.vectors = np.zeros((start, dimensions))
+        self.present = np.zeros(start, dtype=bool)
+        for model, vectors in groups.items():
+            rows = self.slices[model]
+            if isinstance(vectors, np.ndarray):
+                self.vectors[rows] = vectors
+                self.present[rows] = True
+                continue
+            for i, vector in enumerate(vectors, start=rows.start):
+                if vector is not None:
+                    self.vectors[i] = vector
+                    self.present[i] = True
+
+        norms = np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        self.unit = np.divide(
+            self.vectors, norms, out=np.zeros_like(self.vectors), where=norms > 0
+        )
+        self.grids = {}
+        self.measures = {}
+
+    def grid(self, model):
+        if model not in self.grids:
+            unit = self.unit[self.slices[model]]
+            self.grids[model] = unit @ unit.T
+        return self.grids[model]
+
+    def measure(self, model):
+        # Mean cosine similarity between each output and the model's sum.
+        import numpy as np
+
+        if model not in self.measures:
+            rows = self.slices[model]
+            if not self.present[rows].all():
+                self.measures[model] = None
+            else:
+                total = self.vectors[rows].sum(axis=0)
+                similarities = self.unit[rows] @ total / np.linalg.norm(total)
+                self.measures[model] = float(similarities.mean())
+        return self.measures[model]
+
+
+@click.command()
+@click.option("--model", "-m", default="text-embedding-3-small")
+@click.option("--clusters", "-k", default=50, type=click.IntRange(min=1))
+@click.option(
+    "--batch-size",
+    default=1024,
+    type=click.IntRange(min=1),
+    help="Vectors sampled per k-means step.",
+)
+@click.option("--iterations", default=200, type=click.IntRange(min=1))
+def cluster(model, clusters=50, batch_size=1024, iterations=200):
+    survey = SurveyDb()
+    store = EmbeddingStore(model=model)
+    store.sync(survey)
+    if not len(store):
+        raise ValueError(f"No {model} embeddings to cluster")
+
+    centroids = minibatch_kmeans(store.matrix, clusters, batch_size, iterations)
+    labels = assign_clusters(store.matrix, centroids)
+    ids = [output_id for _, _, output_id in store.keys]
+
+    Clusters(centroids, ids, labels).save(clusters_path(store.directory, model))
+    print(f"Assigned {len(ids)} outputs to {len(centroids)} clusters")
+
+
+def normalise(vectors):
+    import numpy as np
+
+    vectors = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=vectors, where=norms > 0)
+
+
+def minibatch_kmeans(matrix, k, batch_size=1024, iterations=200, seed=0):
+    # Spherical mini-batch k-means (Sculley, 2010). Each step reads one random
+    # batch of rows, so matrix can be a memory map much larger than RAM.
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    k = min(k, len(matrix))
+    centroids = kmeans_plus_plus(matrix, k, max(batch_size, 10 * k), rng)
+    counts = np.zeros(k)
+
+    for _ in range(iterations):
+        rows = np.sort(
+            rng.choice(len(matrix), min(batch_size, len(matrix)), replace=False)
+        )
+        batch = normalise(matrix[rows])
+        nearest = (batch @ centroids.T).argmax(axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, nearest, batch)
+        sizes = np.bincount(nearest, minlength=k)
+        updated = sizes > 0
+        counts[updated] += sizes[updated]
+        rate = (sizes[updated] / counts[updated])[:, None]
+        centroids[updated] = (1 - rate) * centroids[updated] + rate * (
+            sums[updated] / sizes[updated][:, None]
+        )
+        centroids = normalise(centroids)
+
+    return centroids
+
+
+def kmeans_plus_plus(matrix, k, sample_size, rng):
+    # Seeds centroids far apart from each other, using a sample of the rows.
+    import numpy as np
+
+    rows = rng.choice(len(matrix), min(sample_size, len(matrix)), replace=False)
+    sample = normalise(matrix[np.sort(rows)])
+
+    centroids = [sample[rng.integers(len(sample))]]
+    distances = np.maximum(1 - sample @ centroids[0], 0)
+    for _ in range(1, k):
+        total = distances.sum()
+        if total > 0:
+            choice = rng.choice(len(sample), p=distances / total)
+        else:
+            choice = rng.integers(len(sample))
+        centroids.append(sample[choice])
+        distances = np.minimum(distances, np.maximum(1 - sample @ sample[choice], 0))
+    return np.array(centroids)
+
+
+def assign_clusters(matrix, centroids, chunk_size=8192):
+    import numpy as np
+
+    labels = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), chunk_size):
+        chunk = normalise(matrix[start : start + chunk_size])
+        labels[start : start + chunk_size] = (chunk @ centroids.T).argmax(axis=1)
+    return labels
+
+
+def clusters_path(directory, model):
+    return Path(directory) / f"{model.replace('/', '--')}.clusters.npz"
+
+
+class Clusters:
+    # Centroids and the cluster of each output, sorted by output id.
+    def __init__(self, centroids, ids, labels):
+        import numpy as np
+
+        order = np.argsort(ids)
+        self.centroids = centroids
+        self.ids = np.asarray(ids)[order]
+        self.labels = np.asarray(labels)[order]
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+
+        if not Path(path).exists():
+            return None
+        saved = np.load(path)
+        return cls(saved["centroids"], saved["ids"], saved["labels"])
+
+    def save(self, path):
+        import numpy as np
 
-    output_sum = sum(output.embedding for output in model_outputs)
-    similarities = [
-        similarity(output_sum, output.embedding) for output in model_outputs
-    ]
-    return sum(similarities) / len(similarities)
+        temporary = Path(path).with_suffix(".tmp.npz")
+        np.savez(temporary, centroids=self.centroids, ids=self.ids, labels=self.labels)
+        temporary.replace(path)
 
+    def labels_for(self, output_ids):
+        # Cluster of each output, or None if it was embedded after clustering.
+        import numpy as np
 
-def consistency_grid(model_outputs):
-    results = {}
-    for i, output in enumerate(model_outputs):
-        for j, output2 in enumerate(model_outputs):
-            results[(i, j)] = similarity(output.embedding, output2.embedding)
-    return results
+        output_ids = np.asarray(output_ids)
+        positions = np.searchsorted(self.ids, output_ids).clip(max=len(self.ids) - 1)
+        found = self.ids[positions] == output_ids
+        return [
+            int(label) if ok else None
+            for label, ok in zip(self.labels[positions], found)
+        ]
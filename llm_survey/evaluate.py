@@ -1,8 +1,25 @@
+import asyncio
+from collections import Counter
+
 import click
 from tqdm import tqdm
 
-from llm_survey.data import Evaluation, SurveyDb
-from llm_survey.query import get_completion, reuse_request_if_possible
+from llm_survey.data import (
+    Evaluation,
+    ResultCache,
+    SurveyDb,
+    dedup_summary,
+    evaluation_key,
+)
+from llm_survey.query import (
+    RateLimiter,
+    clients,
+    get_completion,
+    get_completion_async,
+    model_provider,
+    reuse_request_if_possible,
+    scheduler,
+)
 
 # I think this is the model I did the original marking with.
 # I originally used "openai/gpt-4-turbo-preview" but that's unstable and has been
@@ -10,70 +27,253 @@ from llm_survey.query import get_completion, reuse_request_if_possible
 DEFAULT_EVALUATION_MODEL = "openai/gpt-4-1106-preview"
 
 get_or_reuse_completion = reuse_request_if_possible(get_completion)
+get_or_reuse_completion_async = reuse_request_if_possible(get_completion_async)
 
 
 @click.command()
 @click.option("--dry-run", "-n", is_flag=True)
 @click.option("--limit", "-l", type=int)
 @click.option("--model", "-m", multiple=True)
-@click.option("--evaluation-model", "-e")
+@click.option("--evaluation-model", "-e", multiple=True)
+@click.option(
+    "--concurrency",
+    "-j",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of requests in flight per evaluator. Each provider starts at"
+    " the total for its evaluators and backs off if it is throttled.",
+)
+@click.option(
+    "--rpm",
+    type=click.IntRange(min=1),
+    help="Maximum requests per minute per evaluator.",
+)
+@click.option(
+    "--evaluator-concurrency",
+    type=(str, click.IntRange(min=1)),
+    multiple=True,
+    help="Override --concurrency for one evaluator: MODEL N.",
+)
+@click.option(
+    "--evaluator-rpm",
+    type=(str, click.IntRange(min=1)),
+    multiple=True,
+    help="Override --rpm for one evaluator: MODEL N.",
+)
 @click.argument("prompt_id")
-def evaluate(prompt_id, dry_run=False, limit=None, model=(), evaluation_model=None):
+def evaluate(
+    prompt_id,
+    dry_run=False,
+    limit=None,
+    model=(),
+    evaluation_model=(),
+    concurrency=1,
+    rpm=None,
+    evaluator_concurrency=(),
+    evaluator_rpm=(),
+):
     prompt_template = open("evaluation_prompt_template.md").read()
 
     survey = SurveyDb()
 
-    prompt = survey.get_prompt_outputs(prompt_id)
-
-    evaluation_model_id = evaluation_model or prompt.evaluation_model
-    assert evaluation_model_id is not None, "No evaluation model configured."
-    evaluation_model = survey.get_model(evaluation_model_id)
-    assert (
-        evaluation_model is not None
-    ), f"{evaluation_model_id} is not in the database."
-
-    model_outputs_needing_evaluation = [
-        output
-        for output in prompt.model_outputs
-        if not output.has_evaluation(evaluation_model_id)
-    ]
-
-    if model:
-        model_outputs_needing_evaluation = [
-            output
-            for output in model_outputs_needing_evaluation
-            if any(m in output.model for m in model)
-        ]
+    prompt = survey.get_prompt(prompt_id)
 
-    if limit:
-        model_outputs_needing_evaluation = model_outputs_needing_evaluation[:limit]
+    evaluation_model_ids = evaluation_model or (prompt.evaluation_model,)
+    assert all(evaluation_model_ids), "No evaluation model configured."
 
-    print(
-        f"Running {len(model_outputs_needing_evaluation)} evaluations with {evaluation_model.id}"
-    )
+    work = []
+    for evaluation_model_id in evaluation_model_ids:
+        evaluation_model = survey.get_model(evaluation_model_id)
+        assert (
+            evaluation_model is not None
+        ), f"{evaluation_model_id} is not in the database."
 
-    work = tqdm(model_outputs_needing_evaluation)
-    for model_output in work:
-        work.set_description(f"{model_output.model:30}")
+        output_ids = survey.outputs_missing_evaluation(
+            prompt_id, evaluation_model_id, model, limit
+        )
+        print(f"Running {len(output_ids)} evaluations with {evaluation_model.id}")
+        work.append((evaluation_model, output_ids))
 
-        if dry_run:
-            work.write(f"{model_output.model}")
-            continue
+    sequential = (
+        len(work) == 1
+        and concurrency == 1
+        and not (rpm or evaluator_concurrency or evaluator_rpm)
+    )
+    if dry_run or sequential:
+        for evaluation_model, output_ids in work:
+            evaluate_sequentially(
+                survey,
+                prompt,
+                prompt_template,
+                evaluation_model,
+                output_ids,
+                dry_run,
+            )
+        return
 
-        evaluation_prompt = prompt_template.format(
-            problem=prompt.prompt,
-            marking_scheme=prompt.marking_scheme,
-            solution=model_output.content,
-        )
-        request_id, completion = get_or_reuse_completion(
-            survey,
-            evaluation_model.id,
-            evaluation_prompt,
+    evaluator_concurrency = dict(evaluator_concurrency)
+    evaluator_rpm = dict(evaluator_rpm)
+    limiters = {
+        evaluation_model.id: RateLimiter(
+            concurrency=evaluator_concurrency.get(evaluation_model.id, concurrency),
+            requests_per_minute=evaluator_rpm.get(evaluation_model.id, rpm),
         )
+        for evaluation_model, _ in work
+    }
+
+    provider_concurrency = Counter()
+    for evaluation_model, _ in work:
+        provider_concurrency[model_provider(evaluation_model.id)] += limiters[
+            evaluation_model.id
+        ].concurrency
+    for provider, provider_limit in provider_concurrency.items():
+        scheduler.set_initial_concurrency(provider, provider_limit)
+
+    asyncio.run(evaluate_concurrently(survey, prompt, prompt_template, work, limiters))
+
+
+def format_evaluation_prompt(prompt_template, prompt, model_output):
+    return prompt_template.format(
+        problem=prompt.prompt,
+        marking_scheme=prompt.marking_scheme,
+        solution=model_output.content,
+    )
+
+
+def output_evaluation_key(evaluation_model, prompt, model_output):
+    return evaluation_key(
+        evaluation_model.id, prompt.prompt, prompt.marking_scheme, model_output.content
+    )
+
+
+def evaluation_batches(survey, cache, prompt, evaluation_model, output_ids):
+    # Yields (output, content key, stored evaluation or None), looking the
+    # stored evaluations up one batch of outputs at a time.
+    for outputs in survey.model_output_batches(output_ids):
+        keys = [
+            output_evaluation_key(evaluation_model, prompt, output)
+            for output in outputs
+        ]
+        stored = cache.find(keys)
+        for output, key in zip(outputs, keys):
+            yield output, key, stored.get(key)
+
+
+def evaluate_sequentially(
+    survey, prompt, prompt_template, evaluation_model, output_ids, dry_run=False
+):
+    cache = ResultCache(survey, Evaluation)
+    # Evaluations made during this run, kept apart from the cache since the
+    # writer detaches and expires the rows it commits.
+    made = {}
+    reused = 0
+
+    work = tqdm(total=len(output_ids))
+    with work, survey.batch() as writer:
+        for model_output, key, stored in evaluation_batches(
+            survey, cache, prompt, evaluation_model, output_ids
+        ):
+            work.set_description(f"{model_output.model:30}")
+            work.update()
+
+            cached = stored if stored is not None else made.get(key)
+            if cached is not None:
+                reused += 1
+
+            if dry_run:
+                work.write(f"{model_output.model}")
+                continue
+
+            if cached is not None:
+                writer.insert(cached.copy_for(model_output))
+                continue
+
+            evaluation_prompt = format_evaluation_prompt(
+                prompt_template, prompt, model_output
+            )
+            request_id, completion = get_or_reuse_completion(
+                survey,
+                evaluation_model.id,
+                evaluation_prompt,
+            )
+            evaluation = Evaluation.from_completion(
+                model_output,
+                evaluation_model,
+                completion,
+                request_id,
+            )
+            if evaluation.score is not None:
+                evaluation.content_key = key
+                made[key] = evaluation.copy_for(model_output)
+            writer.insert(evaluation)
+
+    print(dedup_summary(reused, len(output_ids)))
+
+
+async def evaluate_concurrently(survey, prompt, prompt_template, work, limiters):
+    progress = tqdm(total=sum(len(output_ids) for _, output_ids in work))
+    cache = ResultCache(survey, Evaluation)
+    # Identical solutions share one in-flight request per evaluator.
+    requests = {}
+    reused = 0
+
+    async def request_evaluation(evaluation_model, evaluation_prompt):
+        async with limiters[evaluation_model.id]:
+            return await get_or_reuse_completion_async(
+                survey,
+                evaluation_model.id,
+                evaluation_prompt,
+            )
+
+    async def grade(evaluation_model, model_output, key, stored):
+        nonlocal reused
+
+        cached = None if key in requests else stored
+        if cached is not None:
+            reused += 1
+            progress.update()
+            writer.insert(cached.copy_for(model_output))
+            return
+
+        if key in requests:
+            reused += 1
+        else:
+            evaluation_prompt = format_evaluation_prompt(
+                prompt_template, prompt, model_output
+            )
+            requests[key] = asyncio.ensure_future(
+                request_evaluation(evaluation_model, evaluation_prompt)
+            )
+
+        try:
+            request_id, completion = await requests[key]
+        finally:
+            progress.set_description(f"{model_output.model:30}")
+            progress.update()
+
         evaluation = Evaluation.from_completion(
             model_output,
             evaluation_model,
             completion,
             request_id,
         )
-        survey.insert(evaluation)
+        if evaluation.score is not None:
+            evaluation.content_key = key
+        writer.insert(evaluation)
+
+    try:
+        with progress:
+            async with survey.batch() as writer:
+                await asyncio.gather(
+                    *(
+                        grade(evaluation_model, *graded)
+                        for evaluation_model, output_ids in work
+                        for graded in evaluation_batches(
+                            survey, cache, prompt, evaluation_model, output_ids
+                        )
+                    )
+                )
+    finally:
+        await clients.aclose()
+
+    print(dedup_summary(reused, progress.total))
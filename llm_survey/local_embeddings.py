@@ -0,0 +1,118 @@
+from pathlib import Path
+
+import numpy as np
+
+from llm_survey.data import normalise_content
+
+# Odd 64-bit constants for the rolling n-gram hash and the final mix.
+PRIME = np.uint64(0x100000001B3)
+MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+class HashedNgramEmbeddings:
+    # CPU-only embeddings: character n-grams hashed into `buckets`, weighted
+    # by sublinear TF-IDF and reduced to `dimensions` with a seeded Gaussian
+    # random projection. Document frequencies are counted once over every
+    # output in the survey and then kept fixed, so a text always embeds to
+    # the same vector.
+    batch_size = 1024
+    batch_tokens = 2_000_000
+
+    def __init__(
+        self,
+        directory="embedding_store",
+        name="hashed-ngrams",
+        buckets=2**14,
+        dimensions=256,
+        ngrams=(3, 5),
+        seed=0,
+    ):
+        self.path = Path(directory) / f"local--{name}.idf.npy"
+        self.buckets = buckets
+        self.dimensions = dimensions
+        self.ngrams = ngrams
+        self.seed = seed
+        self.idf = np.load(self.path) if self.path.exists() else None
+        self._projection = None
+
+    @property
+    def projection(self):
+        if self._projection is None:
+            rng = np.random.default_rng(self.seed)
+            self._projection = rng.standard_normal(
+                (self.buckets, self.dimensions), dtype=np.float32
+            ) / np.sqrt(self.dimensions, dtype=np.float32)
+        return self._projection
+
+    def ngram_keys(self, contents):
+        # doc * buckets + bucket for every n-gram occurrence in the batch.
+        encoded = [f" {normalise_content(c).lower()} ".encode() for c in contents]
+        lengths = np.array([len(text) for text in encoded])
+        codes = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+        docs = np.repeat(np.arange(len(encoded)), lengths)
+
+        keys = []
+        hashes = codes.copy()
+        for n in range(2, self.ngrams[1] + 1):
+            # hashes[i] covers codes[i : i + n] after this step.
+            hashes = hashes[:-1] * PRIME + codes[n - 1 :]
+            if n < self.ngrams[0]:
+                continue
+            same_doc = docs[: len(hashes)] == docs[n - 1 :]
+            buckets = (hashes[same_doc] * MIX) >> np.uint64(32)
+            buckets = (buckets % np.uint64(self.buckets)).astype(np.int64)
+            keys.append(docs[: len(hashes)][same_doc] * self.buckets + buckets)
+        return np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+
+    def fit(self, contents, batch_size=1024):
+        document_counts = np.zeros(self.buckets, dtype=np.int64)
+        documents = 0
+        for start in range(0, len(contents), batch_size):
+            batch = contents[start : start + batch_size]
+            document_counts += (self.counts(batch) > 0).sum(axis=0)
+            documents += len(batch)
+
+        self.idf = (np.log((1 + documents) / (1 + document_counts)) + 1).astype(
+            np.float32
+        )
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(self.path, self.idf)
+
+    def counts(self, contents):
+        counts = np.bincount(
+            self.ngram_keys(contents), minlength=len(contents) * self.buckets
+        )
+        return counts.reshape(len(contents), self.buckets)
+
+    def vectors(self, contents):
+        counts = self.counts(contents).astype(np.float32)
+        weights = np.log(counts, out=np.zeros_like(counts), where=counts > 0)
+        weights += counts > 0
+        weights *= self.idf
+
+        vectors = weights @ self.projection
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    def embed(self, db, contents, model):
+        if self.idf is None:
+            self.fit(list(db.output_contents()))
+        return None, list(self.vectors(list(contents)))
+
+    def embed_one(self, db, content, model):
+        _, [vector] = self.embed(db, [content], model)
+        return None, vector
+
+
+LOCAL_EMBEDDING_MODELS = {
+    "local/hashed-ngrams": HashedNgramEmbeddings,
+}
+
+
+def local_backend(model, directory="embedding_store"):
+    if model not in LOCAL_EMBEDDING_MODELS:
+        raise ValueError(
+            f"Unknown local embedding model {model!r}; "
+            f"choose from {', '.join(LOCAL_EMBEDDING_MODELS)}"
+        )
+    return LOCAL_EMBEDDING_MODELS[model](directory)
@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+import click
+
+from llm_survey.data import SurveyDb
+
+
+@click.group
+def logs():
+    pass
+
+
+@logs.command
+def reindex():
+    survey = SurveyDb()
+    survey.create_tables()
+
+    count = survey.backfill_request_hashes()
+    click.echo(f"Indexed {count} logged requests.")
+
+
+@logs.command
+@click.option("--samples", default=1000, help="Number of recent requests to sample.")
+@click.option("--size", type=int, help="Dictionary size in bytes.")
+def train(samples, size):
+    survey = SurveyDb()
+    survey.create_tables()
+
+    dictionary_id, dictionary_size = survey.train_compression_dictionary(samples, size)
+    click.echo(f"Trained dictionary {dictionary_id} ({dictionary_size} bytes).")
+
+
+@logs.command
+@click.option("--vacuum", is_flag=True, help="Reclaim the freed space afterwards.")
+def compress(vacuum):
+    survey = SurveyDb()
+    survey.create_tables()
+
+    count = survey.compress_request_logs()
+    click.echo(f"Compressed {count} logged requests.")
+
+    if vacuum:
+        survey.vacuum()
+
+
+@logs.command
+@click.option("--older-than", default=30, help="Archive requests older than DAYS.")
+@click.option("--vacuum", is_flag=True, help="Reclaim the freed space afterwards.")
+def archive(older_than, vacuum):
+    survey = SurveyDb()
+    survey.create_tables()
+
+    survey.compress_request_logs()
+    count = survey.archive_request_logs(timedelta(days=older_than))
+    click.echo(f"Archived {count} logged requests to {survey.archive.directory}.")
+
+    if vacuum:
+        survey.vacuum()
@@ -0,0 +1,204 @@
+import json
+
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session
+
+from llm_survey.data import (
+    ModelAggregate,
+    embedding_key,
+    evaluation_key,
+    parse_score,
+    rebuild_model_aggregates,
+    usage_cost_micros,
+)
+
+# Each migration must also be safe to run against a database that
+# create_all has just built with the current schema.
+MIGRATIONS = []
+
+
+def migration(description):
+    def decorator(f):
+        MIGRATIONS.append((len(MIGRATIONS) + 1, description, f))
+        return f
+
+    return decorator
+
+
+def add_column(connection, table, column, column_type):
+    columns = {column["name"] for column in inspect(connection).get_columns(table)}
+    if column not in columns:
+        connection.execute(
+            text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        )
+
+
+def create_index(connection, name, table, *columns):
+    connection.execute(
+        text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+    )
+
+
+@migration("Hashed, compressed and archived request logs")
+def request_log_storage(connection):
+    add_column(connection, "request_logs", "request_hash", "VARCHAR")
+    add_column(connection, "request_logs", "payload", "BLOB")
+    add_column(connection, "request_logs", "compression", "VARCHAR")
+    add_column(connection, "request_logs", "segment", "VARCHAR")
+    add_column(connection, "request_logs", "segment_offset", "INTEGER")
+    create_index(
+        connection, "ix_request_logs_request_hash", "request_logs", "request_hash"
+    )
+
+
+@migration("Index output, evaluation and embedding lookups")
+def foreign_key_indexes(connection):
+    create_index(
+        connection,
+        "ix_model_outputs_prompt_id_model",
+        "model_outputs",
+        "prompt_id",
+        "model",
+    )
+    create_index(connection, "ix_model_outputs_model", "model_outputs", "model")
+    create_index(
+        connection,
+        "ix_evaluations_model_output_id_model",
+        "evaluations",
+        "model_output_id",
+        "model",
+    )
+    create_index(connection, "ix_evaluations_model", "evaluations", "model")
+    create_index(
+        connection,
+        "ix_embeddings_output_id_model",
+        "embeddings",
+        "output_id",
+        "model",
+    )
+
+
+@migration("Store evaluation scores and costs as columns")
+def scores_and_costs(connection):
+    add_column(connection, "evaluations", "score", "FLOAT")
+    add_column(connection, "evaluations", "cost_micros", "INTEGER")
+    add_column(connection, "model_outputs", "cost_micros", "INTEGER")
+    create_index(connection, "ix_evaluations_score", "evaluations", "score")
+    create_index(connection, "ix_evaluations_cost_micros", "evaluations", "cost_micros")
+    create_index(
+        connection, "ix_model_outputs_cost_micros", "model_outputs", "cost_micros"
+    )
+
+    evaluations = [
+        {
+            "id": id,
+            "score": parse_score(content),
+            "cost_micros": usage_cost_micros(json.loads(usage or "null")),
+        }
+        for id, content, usage in connection.execute(
+            text("SELECT id, content, usage FROM evaluations")
+        )
+    ]
+    if evaluations:
+        connection.execute(
+            text(
+                "UPDATE evaluations SET score = :score, cost_micros = :cost_micros"
+                " WHERE id = :id"
+            ),
+            evaluations,
+        )
+
+    outputs = [
+        {"id": id, "cost_micros": usage_cost_micros(json.loads(usage or "null"))}
+        for id, usage in connection.execute(text("SELECT id, usage FROM model_outputs"))
+    ]
+    if outputs:
+        connection.execute(
+            text("UPDATE model_outputs SET cost_micros = :cost_micros WHERE id = :id"),
+            outputs,
+        )
+
+
+@migration("Per-model running totals")
+def model_aggregates(connection):
+    # Filled in by rebuild_aggregates below, once every column the rebuild
+    # reads exists.
+    ModelAggregate.__table__.create(connection, checkfirst=True)
+
+
+@migration("Embedding storage type")
+def embedding_dtype(connection):
+    add_column(connection, "embeddings", "dtype", "VARCHAR")
+    add_column(connection, "embeddings", "scale", "FLOAT")
+
+
+@migration("Content keys for reusing embeddings and evaluations")
+def content_keys(connection):
+    add_column(connection, "embeddings", "content_key", "VARCHAR")
+    add_column(connection, "evaluations", "content_key", "VARCHAR")
+    create_index(connection, "ix_embeddings_content_key", "embeddings", "content_key")
+    create_index(connection, "ix_evaluations_content_key", "evaluations", "content_key")
+
+    embeddings = [
+        {"id": id, "content_key": embedding_key(model, content)}
+        for id, model, content in connection.execute(
+            text(
+                "SELECT embeddings.id, embeddings.model, model_outputs.content"
+                " FROM embeddings"
+                " JOIN model_outputs ON model_outputs.id = embeddings.output_id"
+            )
+        )
+    ]
+    if embeddings:
+        connection.execute(
+            text("UPDATE embeddings SET content_key = :content_key WHERE id = :id"),
+            embeddings,
+        )
+
+    # Keyed against the prompt as it is now, which is what evaluate uses.
+    evaluations = [
+        {
+            "id": id,
+            "content_key": evaluation_key(evaluator, prompt, marking_scheme, content),
+        }
+        for id, evaluator, content, prompt, marking_scheme in connection.execute(
+            text(
+                "SELECT evaluations.id, evaluations.model, model_outputs.content,"
+                " prompts.prompt, prompts.marking_scheme"
+                " FROM evaluations"
+                " JOIN model_outputs ON model_outputs.id = evaluations.model_output_id"
+                " JOIN prompts ON prompts.id = model_outputs.prompt_id"
+                " WHERE evaluations.score IS NOT NULL"
+            )
+        )
+    ]
+    if evaluations:
+        connection.execute(
+            text("UPDATE evaluations SET content_key = :content_key WHERE id = :id"),
+            evaluations,
+        )
+
+
+# Migrations that go through the ORM read the current schema, so they have
+# to come after every migration that adds a column.
+@migration("Rebuild per-model running totals")
+def rebuild_aggregates(connection):
+    with Session(bind=connection) as session:
+        rebuild_model_aggregates(session)
+        session.flush()
+
+
+@migration("Assign outputs saved without a prompt to marshmallow")
+def legacy_prompt_ids(connection):
+    # run only stored prompt_id once it took a prompt argument; every earlier
+    # output answered marshmallow. Left alone if there is no such prompt.
+    updated = connection.execute(
+        text(
+            "UPDATE model_outputs SET prompt_id = 'marshmallow'"
+            " WHERE prompt_id IS NULL"
+            " AND EXISTS (SELECT 1 FROM prompts WHERE id = 'marshmallow')"
+        )
+    )
+    if updated.rowcount:
+        content_keys(connection)
+        rebuild_aggregates(connection)
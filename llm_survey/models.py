@@ -28,10 +28,11 @@ def fetch():
 
     models_to_add = [Model.from_openai(model) for model in models]
 
-    for model in sorted(models_to_add, key=lambda x: x.id):
-        if model.id in existing_models or is_ignored(model.id):
-            continue
-        survey.insert(model)
+    with survey.batch() as writer:
+        for model in sorted(models_to_add, key=lambda x: x.id):
+            if model.id in existing_models or is_ignored(model.id):
+                continue
+            writer.insert(model)
 
 
 def is_ignored(model_id):
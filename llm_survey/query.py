@@ -1,21 +1,109 @@
+import asyncio
 import functools
+import inspect
+import itertools
 import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+
+def request_resource(f):
+    # Async variants share their request log (and cache) with the sync call.
+    return f.__name__.removesuffix("_async")
+
+
+class ReplayMiss(LookupError):
+    pass
+
+
+class Replay:
+    # Serves logged requests instead of calling the API.
+    def __init__(self):
+        self.configure()
+
+    def configure(self, enabled=False, latency=0.0, source=None):
+        self.enabled = enabled
+        self.latency = latency
+        self.source = source
+
+    def lookup(self, db, resource, args, kwargs):
+        source = self.source or db
+        log = source.get_logged_request(resource, (args, kwargs))
+        if log is None:
+            raise ReplayMiss(
+                f"No logged {resource} request for args={args!r} kwargs={kwargs!r}"
+            )
+
+        if source is db:
+            return log.id, log.response
+        # Copy requests replayed from another database, so the rows created
+        # from them have a local request_id.
+        return db.log_request(resource, (args, kwargs), log.response), log.response
+
+    def delay(self, response):
+        if self.latency != "recorded":
+            return self.latency
+        timing = response.get("timing") if isinstance(response, dict) else None
+        return (timing or {}).get("latency") or 0.0
+
+    def serve(self, db, resource, args, kwargs):
+        request_id, response = self.lookup(db, resource, args, kwargs)
+        time.sleep(self.delay(response))
+        return request_id, response
+
+    async def serve_async(self, db, resource, args, kwargs):
+        request_id, response = self.lookup(db, resource, args, kwargs)
+        await asyncio.sleep(self.delay(response))
+        return request_id, response
+
+
+replay = Replay()
 
 
 def log_request_details(f):
+    resource = request_resource(f)
+
+    if inspect.iscoroutinefunction(f):
+
+        @functools.wraps(f)
+        async def async_wrapper(db, *args, **kwargs):
+            if replay.enabled:
+                return await replay.serve_async(db, resource, args, kwargs)
+            result = await f(*args, **kwargs)
+            request_id = db.log_request(resource, (args, kwargs), result)
+            return (request_id, result)
+
+        return async_wrapper
+
     @functools.wraps(f)
     def wrapper(db, *args, **kwargs):
+        if replay.enabled:
+            return replay.serve(db, resource, args, kwargs)
         result = f(*args, **kwargs)
-        request_id = db.log_request(f.__name__, (args, kwargs), result)
+        request_id = db.log_request(resource, (args, kwargs), result)
         return (request_id, result)
 
     return wrapper
 
 
 def reuse_request_if_possible(f):
+    resource = request_resource(f)
+
+    if inspect.iscoroutinefunction(f):
+
+        @functools.wraps(f)
+        async def async_wrapper(db, *args, **kwargs):
+            request = db.get_logged_request(resource, (args, kwargs))
+            if request:
+                return request.id, request.response
+            return await f(db, *args, **kwargs)
+
+        return async_wrapper
+
     @functools.wraps(f)
     def wrapper(db, *args, **kwargs):
-        request = db.get_logged_request(f.__name__, (args, kwargs))
+        request = db.get_logged_request(resource, (args, kwargs))
         if request:
             return request.id, request.response
         return f(db, *args, **kwargs)
@@ -23,45 +111,520 @@ def reuse_request_if_possible(f):
     return wrapper
 
 
-def get_openrouter_client():
+class RateLimiter:
+    # Bound the requests in flight, and optionally the requests per minute.
+    def __init__(self, concurrency=1, requests_per_minute=None):
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0
+        self.next_start = 0.0
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        if self.interval:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+            try:
+                await asyncio.sleep(start - now)
+            except BaseException:
+                self.semaphore.release()
+                raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class TransientError(Exception):
+    # OpenRouter reports some upstream failures as an error in a 200 response.
+    def __init__(self, result):
+        super().__init__(result["error"].get("message"))
+        self.result = result
+        self.status_code = result["error"].get("code")
+
+
+def check_transient_error(result):
+    error = result.get("error")
+    if isinstance(error, dict) and error.get("code") in RETRYABLE_STATUS:
+        raise TransientError(result)
+    return result
+
+
+def status_code(exc):
+    if isinstance(exc, TransientError):
+        return exc.status_code
+    return getattr(exc, "status_code", None)
+
+
+def is_retryable(exc):
     import openai
 
-    return openai.Client(
-        base_url="https://openrouter.ai/api/v1",
-        api_key=os.environ.get("OPENROUTER_API_KEY"),
-    )
+    if isinstance(exc, (openai.APIConnectionError, TransientError)):
+        return True
+    return status_code(exc) in RETRYABLE_STATUS
+
+
+def is_throttled(exc):
+    return status_code(exc) == 429
+
+
+def retry_after(exc):
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+
+    headers = response.headers
+    if milliseconds := headers.get("retry-after-ms"):
+        try:
+            return float(milliseconds) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    # Additive increase, multiplicative decrease of the requests in flight.
+    def __init__(self, initial=8, minimum=1, maximum=256, decrease=0.5, cooldown=5.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.last_decrease = float("-inf")
+        self.condition = None
+
+    async def __aenter__(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_throttle(self):
+        # Requests already in flight when the limit was cut will also be
+        # throttled, so only back off once per cooldown.
+        now = time.monotonic()
+        if now - self.last_decrease >= self.cooldown:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+            self.last_decrease = now
+
+
+class RequestScheduler:
+    def __init__(
+        self, max_attempts=6, base_delay=1.0, max_delay=60.0, initial_concurrency=8
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.initial_concurrency = initial_concurrency
+        # Per-provider starting limits, from the concurrency callers ask for.
+        self.initial_limits = {}
+        self.limiters = {}
+
+    def set_initial_concurrency(self, provider, concurrency):
+        self.initial_limits[provider] = concurrency
+
+    def limiter(self, provider):
+        loop = asyncio.get_running_loop()
+        key = (provider, loop)
+        if key not in self.limiters:
+            self.limiters = {
+                other: limiter
+                for other, limiter in self.limiters.items()
+                if other[1] is loop
+            }
+            initial = self.initial_limits.get(provider, self.initial_concurrency)
+            self.limiters[key] = AdaptiveLimiter(
+                initial=initial, maximum=max(256, initial)
+            )
+        return self.limiters[key]
+
+    def delay(self, exc, attempt):
+        delay = retry_after(exc)
+        if delay is None:
+            # Full jitter, so throttled workers don't retry in lockstep.
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        return delay
+
+    def give_up(self, exc, attempt):
+        return not is_retryable(exc) or attempt + 1 >= self.max_attempts
+
+    async def call_async(self, provider, request, *args, **kwargs):
+        limiter = self.limiter(provider)
+        for attempt in itertools.count():
+            async with limiter:
+                try:
+                    result = await request(*args, **kwargs)
+                except Exception as exc:
+                    if is_throttled(exc):
+                        limiter.on_throttle()
+                    if self.give_up(exc, attempt):
+                        if isinstance(exc, TransientError):
+                            return exc.result
+                        raise
+                    delay = self.delay(exc, attempt)
+                else:
+                    limiter.on_success()
+                    return result
+            await asyncio.sleep(delay)
+
+    def call(self, provider, request, *args, **kwargs):
+        for attempt in itertools.count():
+            try:
+                return request(*args, **kwargs)
+            except Exception as exc:
+                if self.give_up(exc, attempt):
+                    if isinstance(exc, TransientError):
+                        return exc.result
+                    raise
+                time.sleep(self.delay(exc, attempt))
+
+
+scheduler = RequestScheduler()
+
+
+def model_provider(model):
+    # Throttling on OpenRouter is per upstream provider, not per account.
+    return "openrouter:" + model.split("/")[0]
+
+
+PROVIDERS = {
+    "openrouter": {
+        "base_url": "https://openrouter.ai/api/v1",
+        "api_key": "OPENROUTER_API_KEY",
+    },
+    "openai": {
+        "base_url": None,
+        "api_key": "OPENAI_API_KEY",
+    },
+}
+
+DEFAULT_CLIENT_SETTINGS = {
+    "pool_size": 100,
+    "keepalive": 20,
+    "keepalive_expiry": 30.0,
+    "timeout": 600.0,
+    "connect_timeout": 10.0,
+    "http2": False,
+}
+
+
+class ConnectionStats:
+    def __init__(self):
+        self.requests = 0
+        self.opened = 0
+
+    @property
+    def reused(self):
+        return self.requests - self.opened
+
+    def trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            self.opened += 1
+
+    async def trace_async(self, event, info):
+        self.trace(event, info)
+
+    def __str__(self):
+        return (
+            f"{self.requests} requests: "
+            f"{self.opened} connections opened, {self.reused} reused"
+        )
+
+
+class ClientRegistry:
+    def __init__(self):
+        self.settings = dict(DEFAULT_CLIENT_SETTINGS)
+        self.stats = ConnectionStats()
+        self.clients = {}
+        self.async_clients = {}
+        self.loop = None
+
+    def configure(self, **settings):
+        self.close()
+        self.settings.update(
+            (key, value) for key, value in settings.items() if value is not None
+        )
+
+    def get(self, provider):
+        if provider not in self.clients:
+            self.clients[provider] = self.create(provider, asynchronous=False)
+        return self.clients[provider]
+
+    def get_async(self, provider):
+        # Async connections belong to an event loop, so each asyncio.run gets
+        # its own clients.
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.async_clients = {}
+        if provider not in self.async_clients:
+            self.async_clients[provider] = self.create(provider, asynchronous=True)
+        return self.async_clients[provider]
+
+    def create(self, provider, asynchronous):
+        import httpx
+        import openai
+
+        settings = self.settings
+        options = dict(
+            limits=httpx.Limits(
+                max_connections=settings["pool_size"],
+                max_keepalive_connections=settings["keepalive"],
+                keepalive_expiry=settings["keepalive_expiry"],
+            ),
+            timeout=httpx.Timeout(
+                settings["timeout"], connect=settings["connect_timeout"]
+            ),
+            http2=settings["http2"],
+            follow_redirects=True,
+        )
+
+        if asynchronous:
+
+            async def count_request(request):
+                request.extensions["trace"] = self.stats.trace_async
+
+            async def count_response(response):
+                self.stats.requests += 1
+
+            http_client = httpx.AsyncClient(
+                event_hooks={"request": [count_request], "response": [count_response]},
+                **options,
+            )
+            client_class = openai.AsyncClient
+        else:
+
+            def count_request(request):
+                request.extensions["trace"] = self.stats.trace
+
+            def count_response(response):
+                self.stats.requests += 1
+
+            http_client = httpx.Client(
+                event_hooks={"request": [count_request], "response": [count_response]},
+                **options,
+            )
+            client_class = openai.Client
+
+        config = PROVIDERS[provider]
+        return client_class(
+            base_url=config["base_url"],
+            api_key=os.environ.get(config["api_key"]),
+            http_client=http_client,
+            # Retries are handled by the RequestScheduler.
+            max_retries=0,
+        )
+
+    async def aclose(self):
+        for client in self.async_clients.values():
+            await client.close()
+        self.async_clients = {}
+        self.loop = None
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+        self.async_clients = {}
+        self.loop = None
+
+
+clients = ClientRegistry()
+
+
+def get_openrouter_client():
+    return clients.get("openrouter")
+
+
+def get_openrouter_async_client():
+    return clients.get_async("openrouter")
 
 
 def get_openai_client():
-    import openai
+    return clients.get("openai")
 
-    return openai.Client(
-        api_key=os.environ.get("OPENAI_API_KEY"),
-    )
 
+def completion_messages(prompt):
+    return [
+        {"role": "user", "content": prompt},
+    ]
 
-@log_request_details
-def get_completion(model, prompt):
-    return (
+
+def request_completion(model, prompt):
+    return check_transient_error(
         get_openrouter_client()
         .chat.completions.create(
             model=model,
-            messages=[
-                {"role": "user", "content": prompt},
-            ],
+            messages=completion_messages(prompt),
         )
         .to_dict()
     )
 
 
+async def request_completion_async(model, prompt):
+    completion = await get_openrouter_async_client().chat.completions.create(
+        model=model,
+        messages=completion_messages(prompt),
+    )
+    return check_transient_error(completion.to_dict())
+
+
+class StreamedCompletion:
+    # Assembles streamed chunks into the dict a non-streamed completion
+    # returns, plus a "timing" entry.
+    def __init__(self, model):
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.completion = {"model": model, "usage": None}
+        self.parts = []
+        self.finish_reason = None
+        self.error = None
+
+    def add(self, chunk):
+        if "error" in chunk:
+            self.error = chunk["error"]
+            return
+
+        for key in ("id", "created", "model", "provider"):
+            if key in chunk:
+                self.completion[key] = chunk[key]
+        if chunk.get("usage"):
+            self.completion["usage"] = chunk["usage"]
+
+        for choice in chunk.get("choices", []):
+            if content := choice.get("delta", {}).get("content"):
+                if self.first_token is None:
+                    self.first_token = time.perf_counter()
+                self.parts.append(content)
+            if choice.get("finish_reason"):
+                self.finish_reason = choice["finish_reason"]
+
+    def result(self):
+        end = time.perf_counter()
+        if self.error:
+            return check_transient_error({"error": self.error})
+
+        latency = end - self.start
+        time_to_first_token = (
+            self.first_token - self.start if self.first_token is not None else None
+        )
+        # Providers that ignore include_usage never send a usage chunk; count
+        # content chunks instead, which is one token each for most of them.
+        usage = self.completion["usage"] or {
+            "prompt_tokens": 0,
+            "completion_tokens": len(self.parts),
+            "total_tokens": len(self.parts),
+        }
+        completion_tokens = usage["completion_tokens"]
+        generation_time = latency - (time_to_first_token or 0)
+
+        return {
+            **self.completion,
+            "usage": usage,
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(self.parts)},
+                    "finish_reason": self.finish_reason,
+                }
+            ],
+            "timing": {
+                "time_to_first_token": time_to_first_token,
+                "latency": latency,
+                "tokens_per_second": (
+                    completion_tokens / generation_time if generation_time > 0 else None
+                ),
+            },
+        }
+
+
+def request_completion_streaming(model, prompt):
+    streamed = StreamedCompletion(model)
+    for chunk in get_openrouter_client().chat.completions.create(
+        model=model,
+        messages=completion_messages(prompt),
+        stream=True,
+        stream_options={"include_usage": True},
+    ):
+        streamed.add(chunk.to_dict())
+    return streamed.result()
+
+
+async def request_completion_streaming_async(model, prompt):
+    streamed = StreamedCompletion(model)
+    async for chunk in await get_openrouter_async_client().chat.completions.create(
+        model=model,
+        messages=completion_messages(prompt),
+        stream=True,
+        stream_options={"include_usage": True},
+    ):
+        streamed.add(chunk.to_dict())
+    return streamed.result()
+
+
+@log_request_details
+def get_completion(model, prompt):
+    return scheduler.call(model_provider(model), request_completion, model, prompt)
+
+
+@log_request_details
+async def get_completion_async(model, prompt):
+    return await scheduler.call_async(
+        model_provider(model), request_completion_async, model, prompt
+    )
+
+
 @log_request_details
-def get_models():
+def get_completion_streaming(model, prompt):
+    return scheduler.call(
+        model_provider(model), request_completion_streaming, model, prompt
+    )
+
+
+@log_request_details
+async def get_completion_streaming_async(model, prompt):
+    return await scheduler.call_async(
+        model_provider(model), request_completion_streaming_async, model, prompt
+    )
+
+
+def request_models():
     return get_openrouter_client().models.list().to_dict()
 
 
-@reuse_request_if_possible
 @log_request_details
-def create_embedding(model, content):
+def get_models():
+    return scheduler.call("openrouter", request_models)
+
+
+def request_embedding(model, content):
     return (
         get_openai_client()
         .embeddings.create(
@@ -72,8 +635,46 @@ def create_embedding(model, content):
     )
 
 
+@reuse_request_if_possible
+@log_request_details
+def create_embedding(model, content):
+    return scheduler.call("openai", request_embedding, model, content)
+
+
+class RemoteEmbeddings:
+    # The OpenAI embeddings endpoint. Requests go through the request log,
+    # so they can be reused and replayed.
+    batch_size = 256
+    batch_tokens = 100_000
+
+    def embed(self, db, contents, model):
+        import numpy as np
+
+        request_id, response = create_embedding(db, model, list(contents))
+        data = sorted(response["data"], key=lambda item: item["index"])
+        return request_id, [np.array(item["embedding"]) for item in data]
+
+    def embed_one(self, db, content, model):
+        import numpy as np
+
+        request_id, response = create_embedding(db, model, content)
+        return request_id, np.array(response["data"][0]["embedding"])
+
+
+def embedding_backend(model, directory="embedding_store"):
+    # Backends with (request_id, vectors) = embed(db, contents, model), and
+    # batch_size and batch_tokens defaults. "local/..." models never touch the
+    # network and have no request_id.
+    if model.startswith("local/"):
+        from llm_survey.local_embeddings import local_backend
+
+        return local_backend(model, directory)
+    return RemoteEmbeddings()
+
+
 def embed_content(db, content, model="text-embedding-3-small"):
-    import numpy as np
+    return embedding_backend(model).embed_one(db, content, model)
+
 
-    request_id, response = create_embedding(db, model, content)
-    return request_id, np.array(response["data"][0]["embedding"])
+def embed_contents(db, contents, model="text-embedding-3-small"):
+    return embedding_backend(model).embed(db, contents, model)
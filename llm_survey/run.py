@@ -1,47 +1,127 @@
+import asyncio
+
 import click
 from tqdm import tqdm
 
-from llm_survey.data import ModelOutput, SurveyDb, groupby
+from llm_survey.data import ModelOutput, SurveyDb
 from llm_survey.models import is_ignored
-from llm_survey.query import get_completion
+from llm_survey.query import (
+    clients,
+    get_completion,
+    get_completion_async,
+    get_completion_streaming,
+    get_completion_streaming_async,
+    model_provider,
+    scheduler,
+)
 
 
 @click.command()
 @click.option("--count", default=3)
 @click.option("--dry-run", "-n", is_flag=True)
-def run(dry_run=False, count=3):
+@click.option(
+    "--concurrency",
+    "-j",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of completions to keep in flight at once. Each provider starts"
+    " at this limit and backs off if it is throttled.",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Stream completions to record time to first token and throughput.",
+)
+@click.argument("prompt_id", default="marshmallow")
+def run(prompt_id="marshmallow", dry_run=False, count=3, concurrency=1, stream=False):
     import openai
 
     survey = SurveyDb()
 
-    outputs = survey.model_outputs()
-    grouped_outputs = groupby(outputs, key=lambda x: x.model)
+    output_counts = survey.output_counts(prompt_id)
 
-    prompt = survey.get_prompt("marshmallow")
+    prompt = survey.get_prompt(prompt_id)
 
     models_needing_work = [
         (model, n + 1)
         for model in survey.models()
-        for n in range(count - len(grouped_outputs[model.id]))
+        for n in range(count - output_counts.get(model.id, 0))
         if not is_ignored(model.id)
     ]
 
+    if concurrency > 1 and not dry_run:
+        asyncio.run(
+            run_concurrently(survey, prompt, models_needing_work, concurrency, stream)
+        )
+        return
+
+    complete = get_completion_streaming if stream else get_completion
+
     it = tqdm(models_needing_work, unit="models", postfix={"model": "", "n": ""})
-    for model, n in it:
-        it.set_postfix(model=model.id, n=n)
-        it.write(f"{model.id} {n}")
+    with survey.batch() as writer:
+        for model, n in it:
+            it.set_postfix(model=model.id, n=n)
+            it.write(f"{model.id} {n}")
+
+            if dry_run:
+                continue
+
+            try:
+                request_id, completion = complete(survey, model.id, prompt.prompt)
+            except openai.NotFoundError as exc:
+                print(exc)
+                continue
+
+            save_completion(writer, prompt, model, completion, request_id)
+
+
+async def run_concurrently(
+    survey, prompt, models_needing_work, concurrency, stream=False
+):
+    import openai
+
+    request_completion = (
+        get_completion_streaming_async if stream else get_completion_async
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    for provider in {model_provider(model.id) for model, _ in models_needing_work}:
+        scheduler.set_initial_concurrency(provider, concurrency)
+    it = tqdm(
+        total=len(models_needing_work),
+        unit="models",
+        postfix={"model": "", "n": ""},
+    )
+
+    async def complete(model, n):
+        async with semaphore:
+            it.set_postfix(model=model.id, n=n)
+            it.write(f"{model.id} {n}")
+            try:
+                request_id, completion = await request_completion(
+                    survey, model.id, prompt.prompt
+                )
+            except openai.NotFoundError as exc:
+                it.write(str(exc))
+                return
+            finally:
+                it.update()
+
+        save_completion(writer, prompt, model, completion, request_id)
 
-        if dry_run:
-            continue
+    try:
+        with it:
+            async with survey.batch() as writer:
+                await asyncio.gather(
+                    *(complete(model, n) for model, n in models_needing_work)
+                )
+    finally:
+        await clients.aclose()
 
-        try:
-            request_id, completion = get_completion(survey, model.id, prompt.prompt)
-        except openai.NotFoundError as exc:
-            print(exc)
-            continue
 
-        if hasattr(completion, "error") and completion.error:
-            continue
+def save_completion(writer, prompt, model, completion, request_id):
+    if completion.get("error"):
+        return
 
-        model_output = ModelOutput.from_completion(completion, model, request_id)
-        survey.insert(model_output)
+    model_output = ModelOutput.from_completion(completion, model, request_id)
+    model_output.prompt_id = prompt.id
+    writer.insert(model_output)
@@ -0,0 +1,73 @@
+import click
+
+from llm_survey.data import SurveyDb
+from llm_survey.query import embed_content
+from llm_survey.store import EmbeddingStore, LshIndex, exact_search
+
+
+def find_similar(
+    survey, vector, model="text-embedding-3-small", k=10, exclude=(), store=None
+):
+    # [(ModelOutput, similarity)] across every prompt and model, from the
+    # approximate index.
+    if store is None:
+        store = EmbeddingStore(model=model)
+        store.sync(survey)
+    index = LshIndex(model=model)
+    index.sync(store)
+
+    return load_outputs(survey, index.search(store, vector, k, exclude))
+
+
+def load_outputs(survey, results):
+    outputs = {
+        output.id: output
+        for output in survey.stream_model_outputs(
+            [output_id for output_id, _ in results]
+        )
+    }
+    return [(outputs[output_id], score) for output_id, score in results]
+
+
+@click.command()
+@click.argument("query")
+@click.option("--model", "-m", default="text-embedding-3-small")
+@click.option("--count", "-k", default=10, type=click.IntRange(min=1))
+@click.option(
+    "--exact",
+    is_flag=True,
+    help="Also run an exact search and report the approximate search's recall.",
+)
+def similar(query, model, count=10, exact=False):
+    survey = SurveyDb()
+    store = EmbeddingStore(model=model)
+    store.sync(survey)
+
+    if query.isdigit():
+        vector = store.vector(int(query))
+        if vector is None:
+            raise ValueError(f"Output {query} has no {model} embedding")
+        exclude = {int(query)}
+    else:
+        _, vector = embed_content(survey, query, model=model)
+        exclude = set()
+
+    results = find_similar(survey, vector, model, count, exclude, store)
+    show(results)
+
+    if exact:
+        expected = load_outputs(survey, exact_search(store, vector, count, exclude))
+        click.echo("\nExact:")
+        show(expected)
+
+        found = {output.id for output, _ in results}
+        hits = sum(output.id in found for output, _ in expected)
+        click.echo(f"\nRecall {hits}/{len(expected)}")
+
+
+def show(results):
+    for output, score in results:
+        preview = " ".join(output.content.split())[:60]
+        click.echo(
+            f"{score:.3f} {output.id:>7} {output.prompt_id} {output.model} {preview}"
+        )
@@ -0,0 +1,294 @@
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from llm_survey.data import decode_embedding
+
+
+class EmbeddingStore:
+    # One float32 matrix per embedding model, memory-mapped from a raw .f32
+    # file that sync only ever appends to. The JSON index lists the
+    # (prompt, model, output) key of each row. New rows are sorted by key
+    # within each appended chunk, so the outputs of one model on one prompt
+    # are usually a single slice.
+    def __init__(
+        self,
+        directory="embedding_store",
+        model="text-embedding-3-small",
+        chunk_size=10_000,
+    ):
+        self.directory = Path(directory)
+        self.model = model
+        self.chunk_size = chunk_size
+        self.matrix = None
+        self.dimensions = None
+        self.keys = []
+        self.rows = {}
+        self.last_embedding_id = 0
+        self.load()
+
+    @property
+    def name(self):
+        return self.model.replace("/", "--")
+
+    @property
+    def matrix_path(self):
+        return self.directory / f"{self.name}.f32"
+
+    @property
+    def index_path(self):
+        return self.directory / f"{self.name}.json"
+
+    def __len__(self):
+        return len(self.keys)
+
+    def load(self):
+        if not self.index_path.exists():
+            return
+
+        index = json.loads(self.index_path.read_text())
+        if "dimensions" not in index:
+            # Written by the old sorted .npy layout; the next sync rebuilds.
+            return
+        self.keys = [tuple(key) for key in index["keys"]]
+        self.dimensions = index["dimensions"]
+        self.last_embedding_id = index["last_embedding_id"]
+        self.rows = {output_id: row for row, (_, _, output_id) in enumerate(self.keys)}
+        self.map()
+
+    def map(self):
+        self.matrix = None
+        if self.keys:
+            self.matrix = np.memmap(
+                self.matrix_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(self.keys), self.dimensions),
+            )
+
+    @contextmanager
+    def locked(self):
+        # Serialises syncs from several processes sharing the directory.
+        import fcntl
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / f"{self.name}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def sync(self, survey, rebuild=False):
+        # Append embeddings added since the last sync. Only the first
+        # embedding of each output is kept, matching ModelOutput.embedding.
+        # The index is rewritten last, so rows appended by an interrupted
+        # sync are ignored and overwritten by the next one. rebuild reads
+        # every embedding again, for when stored vectors were rewritten.
+        with self.locked():
+            if rebuild:
+                self.keys = []
+                self.rows = {}
+                self.dimensions = None
+                self.last_embedding_id = 0
+            else:
+                self.load()
+            added = 0
+            chunk = []
+            pending = set()
+            for (
+                embedding_id,
+                output_id,
+                prompt_id,
+                model,
+                blob,
+                dtype,
+                scale,
+            ) in survey.embedding_rows(self.model, after_id=self.last_embedding_id):
+                self.last_embedding_id = embedding_id
+                if output_id in self.rows or output_id in pending:
+                    continue
+                pending.add(output_id)
+                chunk.append(
+                    (
+                        (prompt_id or "", model, output_id),
+                        decode_embedding(blob, dtype, scale),
+                    )
+                )
+                if len(chunk) >= self.chunk_size:
+                    added += self.append(chunk)
+                    chunk = []
+            if chunk:
+                added += self.append(chunk)
+
+            if added or rebuild:
+                self.index_path.with_suffix(".json.tmp").write_text(
+                    json.dumps(
+                        {
+                            "keys": self.keys,
+                            "dimensions": self.dimensions,
+                            "last_embedding_id": self.last_embedding_id,
+                        }
+                    )
+                )
+                os.replace(self.index_path.with_suffix(".json.tmp"), self.index_path)
+                (self.directory / f"{self.name}.npy").unlink(missing_ok=True)
+                self.map()
+            return added
+
+    def append(self, chunk):
+        chunk.sort(key=lambda entry: entry[0])
+        vectors = np.stack([vector for _, vector in chunk]).astype(np.float32)
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.matrix_path, "ab") as f:
+            # Drop anything past the indexed rows first.
+            f.truncate(len(self.keys) * self.dimensions * vectors.itemsize)
+            f.write(vectors.tobytes())
+
+        for key, _ in chunk:
+            self.rows[key[2]] = len(self.keys)
+            self.keys.append(key)
+        return len(chunk)
+
+    def vector(self, output_id):
+        row = self.rows.get(output_id)
+        if row is None:
+            return None
+        return self.matrix[row]
+
+    def vectors(self, output_ids):
+        # A contiguous run of rows comes back as a view of the mapping;
+        # anything else is a list with None for missing embeddings.
+        rows = [self.rows.get(output_id) for output_id in output_ids]
+        if rows and None not in rows and rows == list(range(rows[0], rows[-1] + 1)):
+            return self.matrix[rows[0] : rows[-1] + 1]
+        return [None if row is None else self.matrix[row] for row in rows]
+
+
+class LshIndex:
+    # Random-projection LSH over the vectors in an EmbeddingStore. Each table
+    # hashes a vector to the signs of `bits` random projections. Codes are
+    # kept sorted per table, so a bucket is a searchsorted range.
+    def __init__(
+        self,
+        directory="embedding_store",
+        model="text-embedding-3-small",
+        tables=24,
+        bits=8,
+        seed=0,
+    ):
+        self.path = Path(directory) / f"{model.replace('/', '--')}.lsh.npz"
+        self.tables = tables
+        self.bits = bits
+        self.seed = seed
+        self.planes = None
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.codes = np.zeros((0, tables), dtype=np.int64)
+        self.order = None
+        self.sorted_codes = None
+
+        if self.path.exists():
+            saved = np.load(self.path)
+            self.planes = saved["planes"]
+            self.ids = saved["ids"]
+            self.codes = saved["codes"]
+            self.tables = self.codes.shape[1]
+            self.bits = self.planes.shape[1] // self.tables
+
+    def __len__(self):
+        return len(self.ids)
+
+    def hash(self, vectors):
+        signs = (vectors @ self.planes > 0).reshape(
+            len(vectors), self.tables, self.bits
+        )
+        return signs @ (1 << np.arange(self.bits, dtype=np.int64))
+
+    def add(self, ids, vectors):
+        vectors = np.asarray(vectors)
+        if self.planes is None:
+            rng = np.random.default_rng(self.seed)
+            self.planes = rng.normal(size=(vectors.shape[1], self.tables * self.bits))
+
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self.codes = np.concatenate([self.codes, self.hash(vectors)])
+        self.order = None
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_suffix(".tmp.npz")
+        np.savez(temporary, planes=self.planes, ids=self.ids, codes=self.codes)
+        os.replace(temporary, self.path)
+
+    def sync(self, store, batch_size=10_000, rebuild=False):
+        # Adds the store's vectors that are not indexed yet, or all of them
+        # with rebuild.
+        if rebuild:
+            self.ids = np.zeros(0, dtype=np.int64)
+            self.codes = np.zeros((0, self.tables), dtype=np.int64)
+            self.order = None
+            self.path.unlink(missing_ok=True)
+        indexed = set(self.ids.tolist())
+        new_ids = [output_id for output_id in store.rows if output_id not in indexed]
+        for start in range(0, len(new_ids), batch_size):
+            batch = new_ids[start : start + batch_size]
+            self.add(
+                batch, store.matrix[[store.rows[output_id] for output_id in batch]]
+            )
+        if new_ids:
+            self.save()
+        return len(new_ids)
+
+    def candidates(self, vector):
+        if self.order is None:
+            self.order = np.argsort(self.codes, axis=0, kind="stable")
+            self.sorted_codes = np.take_along_axis(self.codes, self.order, axis=0)
+
+        codes = self.hash(np.asarray(vector)[None, :])[0]
+        positions = []
+        for table, code in enumerate(codes):
+            column = self.sorted_codes[:, table]
+            start = np.searchsorted(column, code, side="left")
+            stop = np.searchsorted(column, code, side="right")
+            positions.append(self.order[start:stop, table])
+        return np.unique(np.concatenate(positions))
+
+    def search(self, store, vector, k=10, exclude=()):
+        if not len(self):
+            return []
+        ids = [
+            output_id
+            for output_id in self.ids[self.candidates(vector)].tolist()
+            if output_id in store.rows and output_id not in exclude
+        ]
+        vectors = store.matrix[[store.rows[output_id] for output_id in ids]]
+        return top_k(ids, vectors, vector, k)
+
+
+def exact_search(store, vector, k=10, exclude=(), batch_size=100_000):
+    # Brute-force cosine over every stored vector, for checking recall.
+    if not len(store):
+        return []
+    ids = np.array([output_id for _, _, output_id in store.keys])
+    results = []
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start : start + batch_size].tolist()
+        keep = [i for i, output_id in enumerate(batch) if output_id not in exclude]
+        vectors = store.matrix[start : start + batch_size][keep]
+        results.extend(top_k([batch[i] for i in keep], vectors, vector, k))
+    return sorted(results, key=lambda result: result[1], reverse=True)[:k]
+
+
+def top_k(ids, vectors, vector, k):
+    # [(output_id, cosine similarity)] for the k vectors closest to vector.
+    if not ids:
+        return []
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(vector)
+    scores = np.divide(vectors @ vector, norms, out=np.zeros(len(ids)), where=norms > 0)
+    k = min(k, len(ids))
+    best = np.argpartition(-scores, k - 1)[:k]
+    best = best[np.argsort(-scores[best], kind="stable")]
+    return [(ids[i], float(scores[i])) for i in best]
@@ -1,9 +1,16 @@
-from unittest.mock import MagicMock, Mock, patch
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
 
 import pytest
 from click.testing import CliRunner
 from llm_survey.cli import cli
 from llm_survey.data import SurveyDb
+from llm_survey.query import (
+    DEFAULT_CLIENT_SETTINGS,
+    ConnectionStats,
+    clients,
+    replay,
+    scheduler,
+)
 
 
 def invoke(*args):
@@ -27,6 +34,16 @@ def fake_empty_environment():
         )
 
 
+@pytest.fixture(autouse=True)
+def reset_clients():
+    yield
+    clients.configure(**DEFAULT_CLIENT_SETTINGS)
+    clients.stats = ConnectionStats()
+    replay.configure()
+    scheduler.initial_limits.clear()
+    SurveyDb.default_profile = "default"
+
+
 @pytest.fixture
 def in_memory_db():
     db = SurveyDb("sqlite://")
@@ -41,33 +58,73 @@ def mock_db(in_memory_db):
         yield in_memory_db
 
 
-@pytest.fixture
-def mock_client():
-    with patch("openai.Client") as mock_get_client:
-
-        def create_chat_completion(model, messages):
-            response = "Response to: " + messages[0]["content"]
-            mock_completion = Mock()
-            mock_completion.to_dict.return_value = {
+def fake_chat_completion(model, messages, stream=False, stream_options=None):
+    response = "Response to: " + messages[0]["content"]
+    if stream:
+        return fake_chat_completion_stream(model, response)
+
+    mock_completion = Mock()
+    mock_completion.to_dict.return_value = {
+        "model": model,
+        "choices": [{"message": {"content": response}}],
+        "usage": {
+            "prompt_tokens": 2,
+            "completion_tokens": 5,
+            "total_tokens": 7,
+        },
+    }
+    return mock_completion
+
+
+def fake_chat_completion_stream(model, response, usage=True):
+    words = response.split(" ")
+    chunks = [
+        {
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": word + " "}}],
+        }
+        for word in words[:-1]
+    ]
+    chunks.append(
+        {
+            "model": model,
+            "choices": [
+                {"index": 0, "delta": {"content": words[-1]}, "finish_reason": "stop"}
+            ],
+        }
+    )
+    if usage:
+        chunks.append(
+            {
                 "model": model,
-                "choices": [{"message": {"content": response}}],
+                "choices": [],
                 "usage": {
                     "prompt_tokens": 2,
                     "completion_tokens": 5,
                     "total_tokens": 7,
                 },
             }
-            return mock_completion
+        )
+    for chunk in chunks:
+        mock_chunk = Mock()
+        mock_chunk.to_dict.return_value = chunk
+        yield mock_chunk
+
+
+@pytest.fixture
+def mock_client():
+    with patch("openai.Client") as mock_get_client:
 
         def create_embedding(model, input):
+            inputs = input if isinstance(input, list) else [input]
             mock_embedding = Mock()
-            mock_embedding.to_dict.return_value = {}
-            mock_embedding.data = [Mock(embedding=[0.2, 0.3])]
             mock_embedding.to_dict.return_value = {
                 "data": [
                     {
+                        "index": index,
                         "embedding": [0.2, 0.3],
                     }
+                    for index, _ in enumerate(inputs)
                 ]
             }
 
@@ -96,8 +153,30 @@ def mock_client():
             return result
 
         openai_client = MagicMock()
-        openai_client.chat.completions.create = Mock(side_effect=create_chat_completion)
+        openai_client.chat.completions.create = Mock(side_effect=fake_chat_completion)
         openai_client.embeddings.create = Mock(side_effect=create_embedding)
         openai_client.models.list = Mock(side_effect=list_models)
         mock_get_client.return_value = openai_client
         yield mock_get_client
+
+
+async def async_chunks(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def fake_async_chat_completion(model, messages, stream=False, stream_options=None):
+    completion = fake_chat_completion(model, messages, stream, stream_options)
+    return async_chunks(completion) if stream else completion
+
+
+@pytest.fixture
+def mock_async_client():
+    with patch("openai.AsyncClient") as mock_get_client:
+        openai_client = MagicMock()
+        openai_client.chat.completions.create = AsyncMock(
+            side_effect=fake_async_chat_completion
+        )
+        openai_client.close = AsyncMock()
+        mock_get_client.return_value = openai_client
+        yield mock_get_client
@@ -1,3 +1,9 @@
+from unittest.mock import patch
+
+import numpy as np
+from llm_survey.build import ModelOutputs
+from llm_survey.data import ModelAggregate
+
 # from unittest.mock import Mock, patch
 
 # import pytest
@@ -35,3 +41,35 @@
 # def test_build(mock_client, mock_db):
 #     runner = CliRunner()
 #     runner.invoke(cli, ["build", "test-prompt"], catch_exceptions=False)
+
+
+def model_outputs(vectors, neighbours_path):
+    aggregates = {}
+    for model, vector in vectors.items():
+        aggregates[(model, "")] = ModelAggregate.empty("p", model, "")
+        aggregates[(model, "")].add()
+        aggregates[(model, "embedding:m")] = ModelAggregate.empty(
+            "p", model, "embedding:m"
+        )
+        aggregates[(model, "embedding:m")].add(embedding=np.array(vector))
+    return ModelOutputs(
+        {model: [] for model in vectors}, {}, aggregates, "m", neighbours_path
+    )
+
+
+def test_nearest_models_are_saved(tmp_path):
+    path = tmp_path / "neighbours.json"
+    vectors = {"a": [1.0, 0.0], "b": [1.0, 0.1], "c": [0.0, 1.0], "d": [1.0, 0.5]}
+
+    outputs = model_outputs(vectors, path)
+    assert outputs.nearest("a", 2) == ["b", "d"]
+    assert outputs.nearest("c", 1) == ["d"]
+
+    outputs = model_outputs(vectors, path)
+    with patch("llm_survey.build.SimilarityMatrix") as matrix:
+        assert outputs.nearest("a", 2) == ["b", "d"]
+    matrix.assert_not_called()
+
+    vectors["c"] = [1.0, 0.05]
+    outputs = model_outputs(vectors, path)
+    assert outputs.nearest("a", 2) == ["c", "b"]
@@ -1,6 +1,23 @@
+import asyncio
+import threading
+from datetime import timedelta
+
 import numpy as np
 import pytest
-from llm_survey.data import Embedding, Evaluation, ModelOutput, SurveyDb
+import sqlalchemy
+from llm_survey.data import (
+    Embedding,
+    Evaluation,
+    ModelAggregate,
+    ModelOutput,
+    Prompt,
+    RequestLog,
+    SurveyDb,
+    embedding_key,
+    evaluation_key,
+)
+from llm_survey.migrations import MIGRATIONS, content_keys
+from sqlalchemy import text
 
 
 @pytest.fixture
@@ -79,3 +96,554 @@ def test_log_and_retrieve_request(in_memory_db):
         "get_completion", [["something-gpt", "prompt"], {"extra": 8}]
     )
     assert response.response == "c"
+
+
+def test_backfill_request_hashes(in_memory_db):
+    with in_memory_db.Session() as session:
+        session.add(
+            RequestLog(
+                resource="get_completion",
+                request=[["something-gpt", "prompt"], {}],
+                response="c",
+            )
+        )
+        session.commit()
+
+    assert (
+        in_memory_db.get_logged_request(
+            "get_completion", (("something-gpt", "prompt"), {})
+        )
+        is None
+    )
+
+    assert in_memory_db.backfill_request_hashes() == 1
+
+    response = in_memory_db.get_logged_request(
+        "get_completion", (("something-gpt", "prompt"), {})
+    )
+    assert response.response == "c"
+
+
+def test_create_tables_adds_missing_columns():
+    db = SurveyDb("sqlite://")
+    with db.engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE request_logs ("
+                "id INTEGER PRIMARY KEY, time DATETIME, resource VARCHAR, "
+                "request JSON, response JSON)"
+            )
+        )
+
+    db.create_tables()
+
+    db.log_request("get_models", ((), {}), {"data": []})
+    assert db.get_logged_request("get_models", ((), {})).response == {"data": []}
+
+
+def test_logged_requests_are_compressed(in_memory_db):
+    request_id = in_memory_db.log_request(
+        "get_completion", (("something-gpt", "prompt"), {}), {"content": "c" * 1000}
+    )
+
+    with in_memory_db.Session() as session:
+        log = session.get(RequestLog, request_id)
+        assert log.compression == "zlib"
+        assert len(log.payload) < 100
+
+    response = in_memory_db.get_logged_request(
+        "get_completion", (("something-gpt", "prompt"), {})
+    )
+    assert response.response == {"content": "c" * 1000}
+
+
+def test_compress_with_trained_dictionary(in_memory_db):
+    with in_memory_db.Session() as session:
+        for n in range(20):
+            session.add(
+                RequestLog(
+                    resource="get_completion",
+                    request=[["something-gpt", f"prompt {n}"], {}],
+                    response={"choices": [{"message": {"content": f"Answer {n}"}}]},
+                )
+            )
+        session.commit()
+
+    dictionary_id, size = in_memory_db.train_compression_dictionary()
+    assert size > 0
+
+    assert in_memory_db.compress_request_logs() == 20
+
+    response = in_memory_db.get_logged_request(
+        "get_completion", (("something-gpt", "prompt 7"), {})
+    )
+    assert response.compression == f"zlib:{dictionary_id}"
+    assert response.response == {"choices": [{"message": {"content": "Answer 7"}}]}
+
+
+def test_logged_requests_use_the_newest_dictionary(in_memory_db):
+    queries = []
+    sqlalchemy.event.listen(
+        in_memory_db.engine,
+        "before_cursor_execute",
+        lambda *args: queries.append(args[2]),
+    )
+
+    for n in range(20):
+        in_memory_db.log_request(
+            "get_completion", (("something-gpt", f"prompt {n}"), {}), {"n": n}
+        )
+    assert sum("compression_dictionaries" in query for query in queries) == 1
+
+    dictionary_id, _ = in_memory_db.train_compression_dictionary()
+    request_id = in_memory_db.log_request(
+        "get_completion", (("something-gpt", "prompt"), {}), {"n": 20}
+    )
+
+    with in_memory_db.Session() as session:
+        log = session.get(RequestLog, request_id)
+        assert log.compression == f"zlib:{dictionary_id}"
+
+
+def test_archived_requests_can_be_reused(tmp_path):
+    db = SurveyDb("sqlite://", archive_dir=tmp_path)
+    db.create_tables()
+
+    request_id = db.log_request("get_models", ((), {}), {"data": ["model"]})
+
+    assert db.archive_request_logs(older_than=timedelta(0)) == 1
+
+    with db.Session() as session:
+        log = session.get(RequestLog, request_id)
+        assert log.payload is None
+        assert (tmp_path / log.segment).exists()
+
+    response = db.get_logged_request("get_models", ((), {}))
+    assert response.id == request_id
+    assert response.response == {"data": ["model"]}
+
+
+def test_batch_writer_flushes_every_size_rows(db):
+    with db.batch(size=2, interval=60) as writer:
+        for n in range(3):
+            writer.insert(ModelOutput(model="test", content=f"Output {n}"))
+        assert len(db.model_outputs()) == 2
+
+    assert len(db.model_outputs()) == 3
+
+
+def test_batch_writer_flushes_on_a_timer(db):
+    async def insert_then_wait():
+        async with db.batch(size=100, interval=0.05) as writer:
+            writer.insert(ModelOutput(model="test", content="Hello, World"))
+            # Nothing else is inserted, but the row is still committed.
+            await asyncio.sleep(0.2)
+            return len(db.model_outputs())
+
+    assert asyncio.run(insert_then_wait()) == 1
+
+
+def test_batch_writer_flushes_on_error(db):
+    with pytest.raises(KeyboardInterrupt):
+        with db.batch(size=100, interval=60) as writer:
+            writer.insert(ModelOutput(model="test", content="Hello, World"))
+            raise KeyboardInterrupt
+
+    assert len(db.model_outputs()) == 1
+
+
+def test_concurrent_profile(tmp_path):
+    db = SurveyDb(f"sqlite:///{tmp_path / 'survey.db'}", profile="concurrent")
+    db.create_tables()
+
+    with db.engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+    def insert_outputs(n):
+        for i in range(20):
+            db.insert(ModelOutput(model=f"model-{n}", content=f"Output {i}"))
+
+    threads = [threading.Thread(target=insert_outputs, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(db.model_outputs()) == 80
+    assert db.writer.thread.is_alive()
+    db.close()
+
+
+def test_maintenance_goes_through_writer_thread(tmp_path, monkeypatch):
+    db = SurveyDb(
+        f"sqlite:///{tmp_path / 'survey.db'}",
+        archive_dir=tmp_path / "archive",
+        profile="concurrent",
+    )
+    writes = []
+    submit = db.writer.submit
+
+    def count_writes(operation):
+        writes.append(operation)
+        return submit(operation)
+
+    monkeypatch.setattr(db.writer, "submit", count_writes)
+
+    db.create_tables()
+    assert len(writes) == len(MIGRATIONS)
+
+    for i in range(3):
+        db.log_request("test", [i], {"n": i})
+    writes.clear()
+    db.train_compression_dictionary()
+    db.compress_request_logs()
+    assert db.archive_request_logs(older_than=timedelta(0)) == 3
+    assert db.backfill_request_hashes() == 0
+    assert len(writes) == 5
+    db.close()
+
+
+def test_model_aggregates_with_two_writers(tmp_path):
+    url = f"sqlite:///{tmp_path / 'survey.db'}"
+    SurveyDb(url).create_tables()
+    writers = [SurveyDb(url, profile="concurrent") for _ in range(2)]
+
+    def insert_outputs(db, first_id):
+        for output_id in range(first_id, first_id + 100):
+            db.insert(
+                ModelOutput(
+                    id=output_id,
+                    model="m",
+                    prompt_id="p",
+                    content="",
+                    usage={"total_cost": "0.01"},
+                )
+            )
+            db.insert(Embedding.from_vector([1.0, 0.0], output_id=output_id, model="e"))
+
+    threads = [
+        threading.Thread(target=insert_outputs, args=(db, 1 + n * 100))
+        for n, db in enumerate(writers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    aggregates = writers[0].model_aggregates("p")
+    assert aggregates[("m", "")].sample_count == 200
+    assert aggregates[("m", "")].cost_micros == 200 * 10_000
+    assert aggregates[("m", "embedding:e")].sample_count == 200
+    assert np.allclose(aggregates[("m", "embedding:e")].embedding, [200.0, 0.0])
+    for db in writers:
+        db.close()
+
+
+BASELINE_SCHEMA = [
+    (
+        "CREATE TABLE models (id VARCHAR PRIMARY KEY, name VARCHAR, "
+        "description VARCHAR, context_length INTEGER, pricing JSON)"
+    ),
+    (
+        "CREATE TABLE prompts (id VARCHAR PRIMARY KEY, prompt VARCHAR, "
+        "evaluation_model VARCHAR, marking_scheme VARCHAR)"
+    ),
+    (
+        "CREATE TABLE request_logs (id INTEGER PRIMARY KEY, time DATETIME, "
+        "resource VARCHAR, request JSON, response JSON)"
+    ),
+    (
+        "CREATE TABLE model_outputs (id INTEGER PRIMARY KEY, content VARCHAR, "
+        "model VARCHAR, usage JSON, request_id INTEGER, prompt_id VARCHAR)"
+    ),
+    (
+        "CREATE TABLE embeddings (id INTEGER PRIMARY KEY, output_id INTEGER, "
+        "embedding BLOB, model VARCHAR, request_id INTEGER)"
+    ),
+    (
+        "CREATE TABLE evaluations (id INTEGER PRIMARY KEY, model_output_id INTEGER, "
+        "content VARCHAR, model VARCHAR, usage JSON, request_id INTEGER)"
+    ),
+]
+
+
+def test_upgrade_old_database():
+    db = SurveyDb("sqlite://")
+    with db.engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(
+            text(
+                "INSERT INTO prompts (id, prompt, marking_scheme) "
+                "VALUES ('p', 'Question', 'Scheme')"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO model_outputs (id, content, model, usage, prompt_id) "
+                """VALUES (1, 'Answer', 'm', '{"total_cost": "0.5"}', 'p')"""
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO embeddings (output_id, embedding, model) "
+                "VALUES (1, :embedding, 'e')"
+            ),
+            {"embedding": np.array([3.0, 4.0]).tobytes()},
+        )
+        connection.execute(
+            text(
+                "INSERT INTO evaluations (model_output_id, content, model) "
+                """VALUES (1, '{"score": 6}', 'g')"""
+            )
+        )
+
+    applied = db.create_tables()
+
+    assert [version for version, _ in applied] == list(range(1, len(MIGRATIONS) + 1))
+    assert db.schema_version() == len(MIGRATIONS)
+    indexes = {
+        index["name"]
+        for index in sqlalchemy.inspect(db.engine).get_indexes("model_outputs")
+    }
+    assert "ix_model_outputs_prompt_id_model" in indexes
+
+    aggregates = db.model_aggregates("p")
+    assert aggregates[("m", "")].cost_micros == 500000
+    assert aggregates[("m", "g")].score_sum == 6
+    assert np.allclose(aggregates[("m", "embedding:e")].embedding, [3.0, 4.0])
+    key = embedding_key("e", "Answer")
+    assert key in db.find_by_content_keys(Embedding, [key])
+
+    assert db.create_tables() == []
+
+
+def test_upgrade_assigns_legacy_outputs_to_marshmallow():
+    db = SurveyDb("sqlite://")
+    with db.engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(
+            text(
+                "INSERT INTO prompts (id, prompt, marking_scheme) "
+                "VALUES ('marshmallow', 'Question', 'Scheme')"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO model_outputs (id, content, model, usage) "
+                """VALUES (1, 'Answer', 'm', '{"total_cost": "0.5"}')"""
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO evaluations (model_output_id, content, model) "
+                """VALUES (1, '{"score": 6}', 'g')"""
+            )
+        )
+
+    db.create_tables()
+
+    assert db.output_counts("marshmallow") == {"m": 1}
+    assert db.outputs_missing_evaluation("marshmallow", "g") == []
+    assert db.model_aggregates("marshmallow")[("m", "g")].score_sum == 6
+    key = evaluation_key("g", "Question", "Scheme", "Answer")
+    assert key in db.find_by_content_keys(Evaluation, [key])
+
+
+def test_score_and_cost_are_stored(db, model_output):
+    db.insert(
+        Evaluation(
+            content='{"total_score": 7.5}',
+            model_output_id=model_output.id,
+            model="just-testing",
+            usage={"total_cost": "0.0012345"},
+        )
+    )
+
+    [evaluation] = db.get_model_output(model_output.id).evaluations
+    assert evaluation.score == 7.5
+    assert evaluation.cost_micros == 1235
+
+    with db.Session() as session:
+        assert session.scalar(
+            sqlalchemy.select(Evaluation.id).where(Evaluation.score > 7)
+        )
+
+
+def test_upgrade_backfills_scores_and_costs():
+    db = SurveyDb("sqlite://")
+    with db.engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE evaluations ("
+                "id INTEGER PRIMARY KEY, model_output_id INTEGER, content VARCHAR, "
+                "model VARCHAR, usage JSON, request_id INTEGER)"
+            )
+        )
+        connection.execute(
+            text(
+                "INSERT INTO evaluations (content, model, usage) VALUES "
+                """('{"score": 4}', 'e', '{"total_cost": "0.5"}'), ('Error', 'e', NULL)"""
+            )
+        )
+
+    db.create_tables()
+
+    with db.Session() as session:
+        assert session.execute(
+            sqlalchemy.select(Evaluation.score, Evaluation.cost_micros).order_by(
+                Evaluation.id
+            )
+        ).all() == [(4.0, 500000), (None, None)]
+
+
+def test_content_keys_ignore_whitespace():
+    assert embedding_key("m", "Two  words\n") == embedding_key("m", " Two words")
+    assert embedding_key("m", "Two words") != embedding_key("n", "Two words")
+    assert evaluation_key("e", "p", "s", "x") != evaluation_key("e", "p", "t", "x")
+
+
+def test_upgrade_backfills_content_keys(db):
+    db.insert(Prompt(id="p", prompt="Question", marking_scheme="Scheme"))
+    db.insert(ModelOutput(id=1, model="m", prompt_id="p", content="An answer"))
+    db.insert(Embedding(output_id=1, model="e", embedding=b""))
+    db.insert(Evaluation(model_output_id=1, model="g", content='{"score": 3}'))
+    db.insert(Evaluation(model_output_id=1, model="g", content="Error"))
+
+    with db.engine.begin() as connection:
+        content_keys(connection)
+
+    key = embedding_key("e", "An answer")
+    assert db.find_by_content_keys(Embedding, [key])[key].output_id == 1
+    with db.Session() as session:
+        assert session.scalars(
+            sqlalchemy.select(Evaluation.content_key).order_by(Evaluation.id)
+        ).all() == [evaluation_key("g", "Question", "Scheme", "An answer"), None]
+
+
+def test_find_by_content_keys_returns_earliest_rows(db):
+    for output_id, key in [(1, "a"), (2, "b"), (3, "a")]:
+        db.insert(ModelOutput(id=output_id, model="m", content="x"))
+        db.insert(
+            Embedding(output_id=output_id, model="e", embedding=b"", content_key=key)
+        )
+
+    found = db.find_by_content_keys(Embedding, ["a", "b", "c", "a"], batch_size=1)
+    assert {key: row.output_id for key, row in found.items()} == {"a": 1, "b": 2}
+
+
+def test_model_aggregates(db):
+    for output_id, (model, score, cost, vector) in enumerate(
+        [
+            ("a", 4, "0.01", [1.0, 0.0]),
+            ("a", 6, "0.03", [0.0, 2.0]),
+            ("b", 9, None, None),
+        ],
+        start=1,
+    ):
+        db.insert(
+            ModelOutput(
+                id=output_id,
+                model=model,
+                prompt_id="p",
+                content="",
+                usage={"total_cost": cost} if cost else None,
+            )
+        )
+        db.insert(
+            Evaluation(
+                model_output_id=output_id,
+                model="e",
+                content=f'{{"score": {score}}}',
+                usage={"total_cost": "0.001"},
+            )
+        )
+        if vector:
+            db.insert(
+                Embedding(output_id=output_id, model="m", embedding=np.array(vector))
+            )
+    # Only the first evaluation or embedding of an output by a model counts.
+    db.insert(Evaluation(model_output_id=1, model="e", content='{"score": 0}'))
+    db.insert(Embedding(output_id=1, model="m", embedding=np.array([5.0, 5.0])))
+
+    def totals():
+        return {
+            key: (
+                aggregate.sample_count,
+                aggregate.cost_micros,
+                aggregate.cost_count,
+                aggregate.score_sum,
+                aggregate.score_count,
+            )
+            for key, aggregate in db.model_aggregates("p").items()
+        }
+
+    expected = {
+        ("a", ""): (2, 40000, 2, 0.0, 0),
+        ("b", ""): (1, 0, 0, 0.0, 0),
+        ("a", "e"): (2, 2000, 2, 10.0, 2),
+        ("b", "e"): (1, 1000, 1, 9.0, 1),
+        ("a", "embedding:m"): (2, 0, 0, 0.0, 0),
+    }
+    assert totals() == expected
+
+    aggregate = db.model_aggregates("p")[("a", "embedding:m")]
+    assert list(aggregate.embedding) == [1.0, 2.0]
+    # Each vector against the sum (1, 2): (1/sqrt(5) + 2/sqrt(5)) / 2.
+    assert aggregate.consistency() == pytest.approx(3 / (2 * 5**0.5))
+
+    with db.Session() as session:
+        session.execute(sqlalchemy.delete(ModelAggregate))
+        session.commit()
+    assert db.rebuild_aggregates() == len(expected)
+    assert totals() == expected
+
+
+def test_evaluations_by_model_keeps_first_evaluation():
+    output = ModelOutput(model="test", content="")
+    first = Evaluation(model="a", content='{"score": 1}')
+    output.evaluations.append(first)
+    output.evaluations.append(Evaluation(model="a", content='{"score": 2}'))
+
+    assert output.evaluation("a") is first
+    assert output.score("a") == 1
+    assert not output.has_evaluation("b")
+
+    output.evaluations.append(Evaluation(model="b", content='{"score": 3}'))
+    assert output.has_evaluation("b")
+    assert output.score("b") == 3
+
+
+def test_planning_queries(db):
+    for output_id, (prompt_id, model) in enumerate(
+        [("p", "x/a"), ("p", "x/a"), ("p", "y/b"), ("q", "x/a")], start=1
+    ):
+        db.insert(
+            ModelOutput(id=output_id, prompt_id=prompt_id, model=model, content="")
+        )
+    db.insert(Embedding(output_id=1, model="embedder", embedding=np.zeros(2)))
+    db.insert(Embedding(output_id=2, model="other", embedding=np.zeros(2)))
+    db.insert(Evaluation(model_output_id=1, model="e", content=""))
+
+    assert db.output_counts("p") == {"x/a": 2, "y/b": 1}
+    assert db.outputs_missing_embedding("embedder") == [2, 3, 4]
+    assert db.outputs_missing_evaluation("p", "e") == [2, 3]
+    assert db.outputs_missing_evaluation("p", "e", models=["b"]) == [3]
+    assert db.outputs_missing_evaluation("p", "e", limit=1) == [2]
+    assert [
+        output.id for output in db.stream_model_outputs([4, 2, 3], batch_size=2)
+    ] == [2, 4, 3]
+
+
+def test_recode_embeddings(db, model_output):
+    db.insert(
+        Embedding(output_id=model_output.id, model="m", embedding=np.array([1.0, -2.0]))
+    )
+
+    assert db.recode_embeddings("int8") == 1
+    assert db.recode_embeddings("int8") == 0
+
+    [embedding] = db.get_model_output(model_output.id).embeddings
+    assert embedding.dtype == "int8"
+    assert np.allclose(embedding.vector, [1.0, -2.0], atol=2 / 127)
@@ -1,7 +1,26 @@
 import numpy as np
+import pytest
 from click.testing import CliRunner
-from llm_survey.data import ModelOutput
-from llm_survey.embeddings import embeddings
+from llm_survey.data import Embedding, ModelOutput, Prompt
+from llm_survey.db import compact_embeddings
+from llm_survey.embeddings import (
+    Clusters,
+    ConsistencyEngine,
+    SimilarityMatrix,
+    cluster,
+    clusters_path,
+    embeddings,
+    minibatch_kmeans,
+    assign_clusters,
+    similarity,
+)
+from llm_survey.local_embeddings import HashedNgramEmbeddings, local_backend
+from llm_survey.store import EmbeddingStore, LshIndex
+
+
+@pytest.fixture(autouse=True)
+def store_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
 
 
 def test_run_one_embedding(mock_client, mock_db):
@@ -12,12 +31,12 @@ def test_run_one_embedding(mock_client, mock_db):
     runner.invoke(embeddings, catch_exceptions=False)
 
     mock_client.return_value.embeddings.create.assert_called_once_with(
-        model="text-embedding-3-small", input="Evaluate this"
+        model="text-embedding-3-small", input=["Evaluate this"]
     )
 
     [model_output] = mock_db.model_outputs()
 
-    assert all(model_output.embedding == np.array([0.2, 0.3]))
+    assert np.allclose(model_output.embedding, [0.2, 0.3])
 
 
 def test_run_two_identical_embeddings(mock_client, mock_db):
@@ -29,11 +48,283 @@ def test_run_two_identical_embeddings(mock_client, mock_db):
     runner.invoke(embeddings, catch_exceptions=False)
 
     mock_client.return_value.embeddings.create.assert_called_once_with(
-        model="text-embedding-3-small", input="Evaluate this"
+        model="text-embedding-3-small", input=["Evaluate this"]
     )
 
     [output1, output2] = mock_db.model_outputs()
 
     assert output1.embeddings[0].request_id == output2.embeddings[0].request_id
-    assert all(output1.embedding == np.array([0.2, 0.3]))
-    assert all(output2.embedding == np.array([0.2, 0.3]))
+    assert np.allclose(output1.embedding, [0.2, 0.3])
+    assert np.allclose(output2.embedding, [0.2, 0.3])
+
+
+def test_embeddings_reuse_whitespace_identical_content(mock_client, mock_db):
+    mock_db.insert(ModelOutput(model="test-model", content="Evaluate this"))
+
+    runner = CliRunner()
+    runner.invoke(embeddings, catch_exceptions=False)
+
+    mock_db.insert(ModelOutput(model="test-model", content="  Evaluate\nthis "))
+    result = runner.invoke(embeddings, catch_exceptions=False)
+
+    mock_client.return_value.embeddings.create.assert_called_once()
+    assert "Reused 1 of 1 results (100%)" in result.output
+
+    output1, output2 = mock_db.model_outputs()
+    assert output1.embeddings[0].request_id == output2.embeddings[0].request_id
+    assert np.allclose(output2.embedding, [0.2, 0.3])
+
+
+def test_batch_embeddings(mock_client, mock_db):
+    for content in ["One", "Two", "Three"]:
+        mock_db.insert(ModelOutput(model="test-model", content=content))
+
+    runner = CliRunner()
+    runner.invoke(embeddings, ["--batch-size", "2"], catch_exceptions=False)
+
+    create = mock_client.return_value.embeddings.create
+    assert [call.kwargs["input"] for call in create.call_args_list] == [
+        ["One", "Two"],
+        ["Three"],
+    ]
+
+    outputs = mock_db.model_outputs()
+    assert all(output.embedding is not None for output in outputs)
+    assert outputs[0].embeddings[0].request_id == outputs[1].embeddings[0].request_id
+    assert outputs[0].embeddings[0].request_id != outputs[2].embeddings[0].request_id
+
+
+def test_embeddings_sync_store(mock_client, mock_db):
+    mock_db.insert(ModelOutput(model="test-model", content="Evaluate this"))
+
+    runner = CliRunner()
+    runner.invoke(embeddings, catch_exceptions=False)
+
+    [output] = mock_db.model_outputs()
+    store = EmbeddingStore()
+    assert len(store) == 1
+    assert np.allclose(store.vector(output.id), [0.2, 0.3])
+
+
+def test_local_embeddings(mock_client, mock_db):
+    for content in [
+        "There are twelve marshmallows in the jar.",
+        "There are 12 marshmallows in this jar.",
+        "The capital of France is Paris.",
+    ]:
+        mock_db.insert(ModelOutput(model="test-model", content=content))
+
+    runner = CliRunner()
+    runner.invoke(embeddings, ["-m", "local/hashed-ngrams"], catch_exceptions=False)
+
+    mock_client.assert_not_called()
+    outputs = mock_db.model_outputs()
+    assert [output.embeddings[0].model for output in outputs] == [
+        "local/hashed-ngrams"
+    ] * 3
+    assert all(output.embeddings[0].request_id is None for output in outputs)
+
+    store = EmbeddingStore(model="local/hashed-ngrams")
+    assert len(store) == 3
+    jar, jar2, paris = (store.vector(output.id) for output in outputs)
+    assert jar @ jar2 > jar @ paris
+    assert np.isclose(np.linalg.norm(jar), 1)
+
+
+def test_hashed_ngram_embeddings_are_stable(tmp_path):
+    backend = HashedNgramEmbeddings(tmp_path)
+    backend.fit(["One answer", "Another answer", "Something else"])
+
+    one = backend.vectors(["One answer"])
+    batch = backend.vectors(["Something else", " One\n answer", ""])
+    assert one.shape == (1, 256)
+    assert np.allclose(one[0], batch[1])
+    assert not batch[2].any()
+
+    reloaded = HashedNgramEmbeddings(tmp_path)
+    assert np.allclose(reloaded.vectors(["One answer"]), one)
+
+
+def test_unknown_local_model():
+    with pytest.raises(ValueError):
+        local_backend("local/missing")
+
+
+def test_embedding_store_groups_outputs(in_memory_db, tmp_path):
+    in_memory_db.insert(Prompt(id="p1", prompt="", marking_scheme=""))
+    in_memory_db.insert(Prompt(id="p2", prompt="", marking_scheme=""))
+    for output_id, (prompt_id, model) in enumerate(
+        [("p2", "a"), ("p1", "b"), ("p1", "a"), ("p2", "a"), ("p1", "a")], start=1
+    ):
+        in_memory_db.insert(
+            ModelOutput(id=output_id, prompt_id=prompt_id, model=model, content="")
+        )
+        in_memory_db.insert(
+            Embedding(
+                output_id=output_id,
+                model="embedder",
+                embedding=np.array([output_id, 0.0]),
+            )
+        )
+
+    store = EmbeddingStore(tmp_path, model="embedder")
+    assert store.sync(in_memory_db) == 5
+    assert store.sync(in_memory_db) == 0
+
+    store = EmbeddingStore(tmp_path, model="embedder")
+    group = store.vectors([3, 5])
+    assert isinstance(group, np.ndarray)
+    assert group.base is not None
+    assert list(group[:, 0]) == [3, 5]
+
+    assert [vector[0] for vector in store.vectors([1, 2])] == [1, 2]
+    assert store.vectors([1, 6])[1] is None
+
+    in_memory_db.insert(
+        Embedding(output_id=2, model="embedder", embedding=np.array([9.0, 9.0]))
+    )
+    assert store.sync(in_memory_db) == 0
+    assert store.vector(2)[0] == 2
+
+
+def test_embedding_store_only_appends(in_memory_db, tmp_path):
+    def add_output(output_id):
+        in_memory_db.insert(
+            ModelOutput(id=output_id, prompt_id="p", model="a", content="")
+        )
+        in_memory_db.insert(
+            Embedding.from_vector(
+                [output_id, 1.0], output_id=output_id, model="embedder"
+            )
+        )
+
+    for output_id in [2, 1]:
+        add_output(output_id)
+    store = EmbeddingStore(tmp_path, model="embedder")
+    store.sync(in_memory_db)
+    before = store.matrix_path.read_bytes()
+
+    # Rows appended by an interrupted sync are not in the index.
+    with open(store.matrix_path, "ab") as f:
+        f.write(b"\xff" * 8)
+
+    add_output(3)
+    assert store.sync(in_memory_db) == 1
+
+    after = store.matrix_path.read_bytes()
+    assert after.startswith(before)
+    assert len(after) == 3 * 2 * 4
+    store = EmbeddingStore(tmp_path, model="embedder")
+    assert [output_id for _, _, output_id in store.keys] == [1, 2, 3]
+    assert np.allclose(store.vectors([1, 2, 3]), [[1, 1], [2, 1], [3, 1]])
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 1024])
+def test_similarity_matrix(block_size):
+    vectors = [np.array([1.0, 0.0]), np.array([1.0, 1.0]), None, np.array([0.0, 3.0])]
+    labels = ["a", "b", "c", "d"]
+
+    matrix = SimilarityMatrix(labels, vectors, block_size=block_size)
+
+    for a, u in zip(labels, vectors):
+        for b, v in zip(labels, vectors):
+            assert matrix[(a, b)] == pytest.approx(similarity(u, v), abs=1e-6)
+    assert matrix.nearest(1)["a"] == ["b"]
+    nearest = matrix.nearest(5)["d"]
+    assert nearest[0] == "b" and sorted(nearest[1:]) == ["a", "c"]
+    assert matrix[("a", "missing")] == 0
+    order = ["d", "missing", "a"]
+    assert matrix.row("a", order) == [matrix[("a", b)] for b in order]
+
+
+def test_consistency_engine():
+    a = np.array([[1.0, 0.0], [1.0, 1.0], [0.0, 2.0]])
+    b = [np.array([3.0, 1.0]), None]
+
+    consistency = ConsistencyEngine({"a": a, "b": b})
+
+    total = a.sum(axis=0)
+    assert consistency.measure("a") == pytest.approx(
+        np.mean([similarity(total, vector) for vector in a])
+    )
+    assert consistency.measure("b") is None
+
+    grid = consistency.grid("a")
+    for i, u in enumerate(a):
+        for j, v in enumerate(a):
+            assert grid[(i, j)] == pytest.approx(similarity(u, v))
+    assert consistency.grid("b").tolist() == [[pytest.approx(1.0), 0.0], [0.0, 0.0]]
+    assert consistency.grid("a") is grid
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32", "int8"])
+def test_embedding_storage_types(mock_client, mock_db, dtype):
+    mock_db.insert(ModelOutput(model="test-model", content="Evaluate this"))
+
+    runner = CliRunner()
+    runner.invoke(embeddings, ["--dtype", dtype], catch_exceptions=False)
+
+    [output] = mock_db.model_outputs()
+    [embedding] = output.embeddings
+    assert embedding.dtype == dtype
+    assert len(embedding.embedding) == 2 * np.dtype(dtype).itemsize
+    assert np.allclose(output.embedding, [0.2, 0.3], atol=0.3 / 127)
+
+
+def test_minibatch_kmeans_separates_clusters():
+    rng = np.random.default_rng(0)
+    centres = np.eye(4, 16) * 10
+    labels = np.arange(400) % 4
+    matrix = centres[labels] + rng.normal(size=(400, 16))
+
+    centroids = minibatch_kmeans(matrix, 4, batch_size=64, iterations=50)
+    assigned = assign_clusters(matrix, centroids, chunk_size=100)
+
+    # Every true cluster maps to exactly one found cluster.
+    assert {(a, b) for a, b in zip(labels, assigned)} == set(
+        zip(range(4), assigned[:4])
+    )
+
+
+def test_cluster_command(mock_db):
+    for output_id in range(1, 9):
+        mock_db.insert(ModelOutput(id=output_id, prompt_id="p", model="m", content=""))
+        mock_db.insert(
+            Embedding(
+                output_id=output_id,
+                model="text-embedding-3-small",
+                embedding=np.array(
+                    [1.0, 0.1 * output_id] if output_id % 2 else [0.1, 1.0]
+                ),
+            )
+        )
+
+    runner = CliRunner()
+    runner.invoke(cluster, ["-k", "2", "--iterations", "20"], catch_exceptions=False)
+
+    clusters = Clusters.load(clusters_path("embedding_store", "text-embedding-3-small"))
+    labels = clusters.labels_for([1, 3, 2, 4, 99])
+    assert labels[0] == labels[1] != labels[2] == labels[3]
+    assert labels[4] is None
+
+
+def test_compact_embeddings_rebuilds_copies(mock_db):
+    mock_db.insert(Prompt(id="p", prompt="Question"))
+    mock_db.insert(ModelOutput(id=1, model="m", prompt_id="p", content="Answer"))
+    mock_db.insert(
+        Embedding.from_vector(np.array([0.1, -2.0]), "float64", output_id=1, model="e")
+    )
+    store = EmbeddingStore(model="e")
+    store.sync(mock_db)
+    LshIndex(model="e").sync(store)
+
+    runner = CliRunner()
+    runner.invoke(compact_embeddings, ["--dtype", "int8"], catch_exceptions=False)
+
+    vector = mock_db.get_model_output(1).embeddings[0].vector
+    assert not np.allclose(vector, [0.1, -2.0])
+    assert np.allclose(EmbeddingStore(model="e").vector(1), vector)
+    assert np.allclose(
+        mock_db.model_aggregates("p")[("m", "embedding:e")].embedding, vector
+    )
+    assert LshIndex(model="e").ids.tolist() == [1]
@@ -1,5 +1,16 @@
+from unittest.mock import Mock
+
 import pytest
-from llm_survey.data import Model, ModelOutput, Prompt
+from llm_survey.data import (
+    BatchWriter,
+    Evaluation,
+    Model,
+    ModelOutput,
+    Prompt,
+    SurveyDb,
+    evaluation_key,
+)
+from llm_survey.query import scheduler
 
 from conftest import invoke
 
@@ -59,3 +70,111 @@ def test_evaluate_two_identical(mock_client, mock_db):
     output1, output2 = mock_db.model_outputs()
     output1.evaluations[0].request_id == output2.evaluations[0].request_id
     output1.evaluation == output2.evaluation
+
+
+def test_evaluate_reuses_evaluation_of_identical_answer(mock_client, mock_db):
+    mock_db.insert(
+        ModelOutput(id=1, prompt_id="marshmallow", model="a", content="Three")
+    )
+    mock_db.insert(
+        Evaluation(
+            model_output_id=1,
+            model="test-evaluator",
+            content='{"score": 3}',
+            request_id=7,
+            content_key=evaluation_key(
+                "test-evaluator",
+                "How many marshmallows are there?",
+                "Award one mark for every marshmallow",
+                "Three",
+            ),
+        )
+    )
+    mock_db.insert(
+        ModelOutput(id=2, prompt_id="marshmallow", model="b", content="Three\n")
+    )
+
+    result = invoke("evaluate", "marshmallow")
+
+    mock_client.return_value.chat.completions.create.assert_not_called()
+    assert "Reused 1 of 1 results (100%)" in result.output
+    [evaluation] = mock_db.get_model_output(2).evaluations
+    assert evaluation.request_id == 7
+    assert evaluation.score == 3
+
+
+def test_evaluate_reuses_evaluation_after_flush(mock_client, mock_db, monkeypatch):
+    # Commit after every row, so the first evaluation has been written and
+    # detached before the duplicates need it.
+    monkeypatch.setattr(
+        SurveyDb, "batch", lambda self, size=1, interval=0.5: BatchWriter(self, 1)
+    )
+
+    def scored_completion(model, messages):
+        completion = Mock()
+        completion.to_dict.return_value = {
+            "model": model,
+            "choices": [{"message": {"content": '{"score": 3}'}}],
+            "usage": {"prompt_tokens": 2, "completion_tokens": 5, "total_tokens": 7},
+        }
+        return completion
+
+    create = mock_client.return_value.chat.completions.create
+    create.side_effect = scored_completion
+    for content in ["Three", "Three\n", " Three"]:
+        mock_db.insert(
+            ModelOutput(prompt_id="marshmallow", model="test-model", content=content)
+        )
+
+    result = invoke("evaluate", "marshmallow")
+
+    create.assert_called_once()
+    assert "Reused 2 of 3 results (67%)" in result.output
+    assert [output.score("test-evaluator") for output in mock_db.model_outputs()] == [
+        3,
+        3,
+        3,
+    ]
+
+
+def test_evaluate_with_several_evaluators(mock_async_client, mock_db):
+    mock_db.insert(
+        Model(
+            id="other-evaluator",
+            pricing={
+                "prompt": "0.01",
+                "completion": "1.00",
+            },
+        )
+    )
+    for content in ["Evaluate this", "Evaluate that"]:
+        mock_db.insert(
+            ModelOutput(
+                prompt_id="marshmallow",
+                model="test-model",
+                content=content,
+            )
+        )
+
+    invoke(
+        "evaluate",
+        "marshmallow",
+        "-e",
+        "test-evaluator",
+        "-e",
+        "other-evaluator",
+        "--evaluator-concurrency",
+        "other-evaluator",
+        "2",
+    )
+
+    create = mock_async_client.return_value.chat.completions.create
+    assert create.await_count == 4
+    assert scheduler.initial_limits == {
+        "openrouter:test-evaluator": 1,
+        "openrouter:other-evaluator": 2,
+    }
+
+    for output in mock_db.model_outputs():
+        assert output.has_evaluation("test-evaluator")
+        assert output.has_evaluation("other-evaluator")
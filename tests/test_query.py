@@ -1,4 +1,26 @@
-from llm_survey.query import log_request_details, reuse_request_if_possible
+import asyncio
+from unittest.mock import Mock
+
+import httpx
+import openai
+import pytest
+from conftest import invoke
+from llm_survey.data import SurveyDb
+from llm_survey.query import (
+    AdaptiveLimiter,
+    ConnectionStats,
+    RateLimiter,
+    ReplayMiss,
+    RequestScheduler,
+    check_transient_error,
+    clients,
+    replay,
+    retry_after,
+    get_openai_client,
+    get_openrouter_client,
+    log_request_details,
+    reuse_request_if_possible,
+)
 
 
 @reuse_request_if_possible
@@ -20,3 +42,166 @@ def test_different_logged_request(in_memory_db):
     request_id_2, result_2 = fake_completion(in_memory_db, "test-model-2", "Hi")
 
     assert request_id_1 != request_id_2
+
+
+def test_rate_limiter_bounds_concurrency():
+    limiter = RateLimiter(concurrency=2)
+    in_flight = 0
+    peak = 0
+
+    async def request():
+        nonlocal in_flight, peak
+        async with limiter:
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    async def main():
+        await asyncio.gather(*(request() for _ in range(6)))
+
+    asyncio.run(main())
+
+    assert peak == 2
+
+
+def test_clients_are_shared(mock_client):
+    assert get_openai_client() is get_openai_client()
+    assert get_openrouter_client() is get_openrouter_client()
+    assert mock_client.call_count == 2
+
+
+def test_connection_stats():
+    stats = ConnectionStats()
+    stats.trace("connection.connect_tcp.started", {})
+    stats.trace("connection.connect_tcp.complete", {})
+    stats.requests = 3
+
+    assert stats.opened == 1
+    assert stats.reused == 2
+
+
+def api_error(error_class, status, headers=None):
+    request = httpx.Request("POST", "https://openrouter.ai/api/v1/chat/completions")
+    response = httpx.Response(status, headers=headers, request=request)
+    return error_class("failed", response=response, body=None)
+
+
+def test_scheduler_retries_throttled_requests():
+    scheduler = RequestScheduler(base_delay=0)
+    attempts = []
+
+    async def request():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise api_error(openai.RateLimitError, 429, {"retry-after": "0"})
+        return "done"
+
+    async def main():
+        result = await scheduler.call_async("test", request)
+        return result, scheduler.limiter("test")
+
+    result, limiter = asyncio.run(main())
+
+    assert result == "done"
+    assert len(attempts) == 3
+    assert limiter.limit < scheduler.initial_concurrency
+
+
+def test_scheduler_starts_at_requested_concurrency():
+    scheduler = RequestScheduler()
+    scheduler.set_initial_concurrency("busy", 300)
+
+    async def limits():
+        return scheduler.limiter("busy").limit, scheduler.limiter("other").limit
+
+    assert asyncio.run(limits()) == (300, scheduler.initial_concurrency)
+
+
+def test_scheduler_does_not_retry_client_errors():
+    scheduler = RequestScheduler(base_delay=0)
+    request = Mock(side_effect=api_error(openai.BadRequestError, 400))
+
+    with pytest.raises(openai.BadRequestError):
+        scheduler.call("test", request)
+
+    assert request.call_count == 1
+
+
+def test_scheduler_returns_transient_error_when_exhausted():
+    scheduler = RequestScheduler(max_attempts=2, base_delay=0)
+    completion = {"error": {"code": 502, "message": "Upstream failed"}}
+    request = Mock(side_effect=lambda: check_transient_error(completion))
+
+    assert scheduler.call("test", request) == completion
+    assert request.call_count == 2
+
+
+def test_retry_after_header():
+    assert retry_after(api_error(openai.RateLimitError, 429, {"retry-after": "7"})) == 7
+    assert retry_after(api_error(openai.RateLimitError, 429)) is None
+
+
+def test_adaptive_limiter():
+    limiter = AdaptiveLimiter(initial=4, cooldown=60)
+
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.limit == 2
+
+    for _ in range(4):
+        limiter.on_success()
+    assert 3 < limiter.limit < 4
+
+
+def test_replay_serves_logged_request(in_memory_db):
+    @log_request_details
+    def offline_completion(model, prompt):
+        raise AssertionError("Replay should not call the API")
+
+    request_id = in_memory_db.log_request(
+        "offline_completion", (("test-model", "Hi"), {}), {"result": "hello"}
+    )
+
+    replay.configure(enabled=True)
+
+    assert offline_completion(in_memory_db, "test-model", "Hi") == (
+        request_id,
+        {"result": "hello"},
+    )
+
+
+def test_replay_miss(in_memory_db):
+    replay.configure(enabled=True)
+
+    with pytest.raises(ReplayMiss):
+        fake_completion(in_memory_db, "test-model", "Never asked")
+
+
+def test_replay_from_another_db(in_memory_db):
+    source = SurveyDb("sqlite://")
+    source.create_tables()
+    source_id, result = fake_completion(source, "test-model", "Hi")
+
+    replay.configure(enabled=True, source=source)
+    request_id, replayed = fake_completion(in_memory_db, "test-model", "Hi")
+
+    assert replayed == result
+    assert (
+        in_memory_db.get_logged_request(
+            "fake_completion", (("test-model", "Hi"), {})
+        ).id
+        == request_id
+    )
+
+
+def test_replay_models_fetch(mock_client, mock_db):
+    invoke("models", "fetch")
+    model_count = len(mock_db.models())
+
+    mock_client.reset_mock()
+    clients.close()
+    invoke("--replay", "models", "fetch")
+
+    mock_client.assert_not_called()
+    assert len(mock_db.models()) == model_count
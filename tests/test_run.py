@@ -1,6 +1,8 @@
 import pytest
 from click.testing import CliRunner
+from conftest import fake_chat_completion_stream
 from llm_survey.data import Model, Prompt
+from llm_survey.query import scheduler
 from llm_survey.run import run
 
 
@@ -36,6 +38,137 @@ def test_run_with_model(mock_client, mock_db):
     assert outputs[0].model == "test_model"
     assert outputs[0].content == "Response to: Test prompt"
     assert outputs[0].request_id is not None
+    assert outputs[0].prompt_id == "marshmallow"
+
+
+def test_run_counts_outputs_per_prompt(mock_client, mock_db):
+    mock_db.insert(
+        Model(
+            id="test_model",
+            name="Test Model",
+            pricing={"prompt": 0.001, "completion": 0.002},
+        )
+    )
+    mock_db.insert(Prompt(id="marshmallow", prompt="Test prompt"))
+    mock_db.insert(Prompt(id="other", prompt="Other prompt"))
+
+    runner = CliRunner()
+    runner.invoke(run, ["--count", "1"], catch_exceptions=False)
+    runner.invoke(run, ["--count", "1", "other"], catch_exceptions=False)
+    runner.invoke(run, ["--count", "1", "other"], catch_exceptions=False)
+
+    outputs = mock_db.model_outputs()
+    assert sorted(output.prompt_id for output in outputs) == ["marshmallow", "other"]
+
+
+def test_run_concurrently(mock_async_client, mock_db):
+    for model_id in ["test/model-a", "test/model-b"]:
+        mock_db.insert(
+            Model(
+                id=model_id,
+                name=model_id,
+                pricing={"prompt": 0.001, "completion": 0.002},
+            )
+        )
+
+    prompt = Prompt(id="marshmallow", prompt="Test prompt")
+    mock_db.insert(prompt)
+
+    runner = CliRunner()
+    runner.invoke(run, ["--count", "2", "--concurrency", "3"], catch_exceptions=False)
+
+    assert scheduler.initial_limits == {"openrouter:test": 3}
+
+    create = mock_async_client.return_value.chat.completions.create
+    assert create.await_count == 4
+
+    outputs = mock_db.model_outputs()
+    assert sorted(output.model for output in outputs) == [
+        "test/model-a",
+        "test/model-a",
+        "test/model-b",
+        "test/model-b",
+    ]
+    assert all(output.request_id is not None for output in outputs)
+
+
+def test_run_streaming(mock_client, mock_db):
+    mock_db.insert(
+        Model(
+            id="test_model",
+            name="Test Model",
+            pricing={"prompt": 0.001, "completion": 0.002},
+        )
+    )
+    mock_db.insert(Prompt(id="marshmallow", prompt="Test prompt"))
+
+    runner = CliRunner()
+    runner.invoke(run, ["--count", "1", "--stream"], catch_exceptions=False)
+
+    [output] = mock_db.model_outputs()
+    assert output.content == "Response to: Test prompt"
+    assert output.usage["completion_tokens"] == 5
+    assert output.timing("time_to_first_token") >= 0
+    assert output.timing("latency") >= output.timing("time_to_first_token")
+    assert output.timing("tokens_per_second") > 0
+
+
+def test_run_streaming_without_usage(mock_client, mock_db):
+    mock_db.insert(
+        Model(
+            id="test_model",
+            name="Test Model",
+            pricing={"prompt": 0.001, "completion": 0.002},
+        )
+    )
+    mock_db.insert(Prompt(id="marshmallow", prompt="Test prompt"))
+    mock_client.return_value.chat.completions.create.side_effect = (
+        lambda model, messages, **kwargs: fake_chat_completion_stream(
+            model, "Response to: Test prompt", usage=False
+        )
+    )
+
+    runner = CliRunner()
+    runner.invoke(run, ["--count", "1", "--stream"], catch_exceptions=False)
+
+    [output] = mock_db.model_outputs()
+    assert output.content == "Response to: Test prompt"
+    assert output.usage["prompt_tokens"] == 0
+    assert output.usage["completion_tokens"] == 4
+    assert output.timing("tokens_per_second") > 0
+
+
+def test_run_streaming_concurrently(mock_async_client, mock_db):
+    for model_id in ["test/model-a", "test/model-b"]:
+        mock_db.insert(
+            Model(
+                id=model_id,
+                name=model_id,
+                pricing={"prompt": 0.001, "completion": 0.002},
+            )
+        )
+    mock_db.insert(Prompt(id="marshmallow", prompt="Test prompt"))
+
+    runner = CliRunner()
+    runner.invoke(
+        run,
+        ["--count", "1", "--stream", "--concurrency", "2"],
+        catch_exceptions=False,
+    )
+
+    create = mock_async_client.return_value.chat.completions.create
+    assert create.await_count == 2
+    assert all(call.kwargs["stream"] for call in create.await_args_list)
+
+    outputs = mock_db.model_outputs()
+    assert sorted(output.model for output in outputs) == [
+        "test/model-a",
+        "test/model-b",
+    ]
+    for output in outputs:
+        assert output.content == "Response to: Test prompt"
+        assert output.usage["completion_tokens"] == 5
+        assert output.timing("latency") >= output.timing("time_to_first_token")
 
 
 if __name__ == "__main__":
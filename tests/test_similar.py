@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from llm_survey.data import Embedding, ModelOutput
+from llm_survey.store import EmbeddingStore, LshIndex, exact_search
+
+from conftest import invoke
+
+
+@pytest.fixture(autouse=True)
+def store_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def vectors():
+    rng = np.random.default_rng(0)
+    centres = rng.normal(size=(20, 32))
+    return centres[np.arange(200) % 20] + rng.normal(size=(200, 32)) * 0.2
+
+
+def test_lsh_index_finds_exact_neighbours(in_memory_db, tmp_path, vectors):
+    for output_id, vector in enumerate(vectors, start=1):
+        in_memory_db.insert(
+            ModelOutput(id=output_id, prompt_id="p", model="m", content="")
+        )
+        in_memory_db.insert(
+            Embedding(output_id=output_id, model="embedder", embedding=vector)
+        )
+
+    store = EmbeddingStore(tmp_path, model="embedder")
+    store.sync(in_memory_db)
+    index = LshIndex(tmp_path, model="embedder")
+    assert index.sync(store) == 200
+    assert LshIndex(tmp_path, model="embedder").sync(store) == 0
+
+    index = LshIndex(tmp_path, model="embedder")
+    expected = exact_search(store, vectors[0], k=5, exclude={1})
+    results = index.search(store, vectors[0], k=5, exclude={1})
+
+    assert [output_id for output_id, _ in results] == [
+        output_id for output_id, _ in expected
+    ]
+    assert all((output_id - 1) % 20 == 0 for output_id, _ in results)
+
+
+def test_similar_command(mock_client, mock_db, vectors):
+    for output_id, vector in enumerate(vectors[:40], start=1):
+        mock_db.insert(
+            ModelOutput(
+                id=output_id, prompt_id="p", model="m", content=f"Answer {output_id}"
+            )
+        )
+        mock_db.insert(
+            Embedding(
+                output_id=output_id, model="text-embedding-3-small", embedding=vector
+            )
+        )
+
+    result = invoke("similar", "1", "-k", "1", "--exact")
+
+    assert "Answer 21" in result.output
+    assert "Recall 1/1" in result.output